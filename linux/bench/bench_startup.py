@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Measure headless startup: module import cost and exec-to-first-switch time.
+
+Runs ``usb_monitor.py --oneshot`` repeatedly with no display in the
+environment, so the measured path is the one the systemd service takes. The
+target is under one second from exec until the monitors are on the correct
+input. Run it on the machine with the monitor attached:
+
+    python3 linux/bench/bench_startup.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+SCRIPT = os.path.join(SRC_DIR, "usb_monitor.py")
+GUI_MODULES = ("tkinter", "PIL", "pystray", "gi")
+TARGET_SECONDS = 1.0
+
+
+def headless_env() -> dict:
+    env = os.environ.copy()
+    for name in ("DISPLAY", "WAYLAND_DISPLAY", "XDG_SESSION_TYPE"):
+        env.pop(name, None)
+    return env
+
+
+def measure_import(env: dict) -> dict:
+    """Import usb_monitor in a fresh interpreter and report time and GUI leaks."""
+    code = (
+        "import sys, time; start = time.perf_counter(); import usb_monitor; "
+        "elapsed = time.perf_counter() - start; "
+        f"print(elapsed, ','.join(m for m in {GUI_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=SRC_DIR, env=env, check=True, capture_output=True, text=True
+    ).stdout.split()
+    return {
+        "import_seconds": float(output[0]),
+        "gui_modules_loaded": output[1].split(",") if len(output) > 1 else [],
+    }
+
+
+def measure_oneshot(env: dict, runs: int) -> dict:
+    """Time ``--oneshot`` runs from exec to exit."""
+    samples = []
+    failures = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, SCRIPT, "--oneshot"], cwd=SRC_DIR, env=env,
+                                capture_output=True)
+        samples.append(time.perf_counter() - start)
+        failures += result.returncode != 0
+    samples.sort()
+    return {
+        "runs": runs,
+        "failures": failures,
+        "min_seconds": samples[0],
+        "median_seconds": statistics.median(samples),
+        "max_seconds": samples[-1],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="number of --oneshot runs")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    env = headless_env()
+    report = measure_import(env)
+    report.update(measure_oneshot(env, args.runs))
+    report["target_seconds"] = TARGET_SECONDS
+    report["passed"] = (
+        report["median_seconds"] < TARGET_SECONDS
+        and not report["failures"]
+        and not report["gui_modules_loaded"]
+    )
+    text = json.dumps(report, indent=4)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Benchmark detection and switching against fake udev and fake monitors.
+
+Drives the real daemon core (presence index, rules, debounce scheduler, bus
+workers) with a scripted uevent source and fake DDC/CI backends, so it runs
+on any Linux box without monitors or USB devices attached. Each cycle plugs
+or unplugs the trigger keyboard, optionally inside a burst of unrelated
+devices as a USB switch would produce, and waits for the flip to finish.
+With ``--hub-delay`` the switch's own hub is announced that long before the
+devices behind it, as real hubs are, to measure early triggering from the
+hub topology.
+The daemon is then left idle to measure its background CPU and wakeups.
+
+    python3 linux/bench/bench_switching.py --cycles 50 --output switching.json
+
+Runs are deterministic for a given ``--seed``.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+
+import core  # noqa: E402
+import ddc  # noqa: E402
+import discovery  # noqa: E402
+import metrics  # noqa: E402
+import presence  # noqa: E402
+import rules  # noqa: E402
+import scheduler  # noqa: E402
+import switching  # noqa: E402
+from fakes import FakeDevice, FakeUdev, backend_factory  # noqa: E402
+
+KEYBOARD = ("046d", "c31c")
+HUB = ("1a40", "0101")
+HUB_PATH = "/devices/usb1/1-1"
+FLIP_TIMEOUT = 10.0
+
+
+def usage() -> dict:
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "cpu": rusage.ru_utime + rusage.ru_stime,
+        "wakeups": rusage.ru_nvcsw + rusage.ru_nivcsw,
+        "max_rss_kb": rusage.ru_maxrss,
+    }
+
+
+def rss_kb() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def build_daemon(args, udev: FakeUdev, capabilities_path: str):
+    config = {
+        "keyboard_id": ":".join(KEYBOARD),
+        "monitors": [{"name": f"monitor{i + 1}", "bus": str(i + 1)} for i in range(args.monitors)],
+    }
+    input_cache = ddc.InputStateCache(args.input_cache_ttl)
+    factory = backend_factory(args.ddc_latency / 1000, args.failure_rate, args.seed)
+    engine = switching.SwitchEngine(
+        switching.load_displays(config), "fake", "", input_cache,
+        discovery.CapabilitiesCache(capabilities_path), backend_factory=factory,
+    )
+    daemon = core.Daemon(
+        udev,
+        presence.PresenceIndex(),
+        rules.RuleSet(rules.compile_rules(config)),
+        scheduler.SwitchScheduler(args.settle, args.hold),
+        engine,
+        input_cache,
+        reconcile_interval=0,
+        ready_timeout=0,
+        detector=udev,
+        hub_confirm_timeout=args.hub_confirm_timeout,
+    )
+    return daemon, factory
+
+
+def emit_devices(udev: FakeUdev, action: str, burst: int) -> None:
+    """Emit the trigger keyboard behind the hub, after ``burst - 1`` unrelated devices."""
+    for extra in range(burst - 1):
+        udev.emit(FakeDevice(action, f"{HUB_PATH}/1-1.{extra + 2}", "1a40", f"{extra:04x}"))
+    udev.emit(FakeDevice(action, f"{HUB_PATH}/1-1.1", *KEYBOARD))
+
+
+async def wait_for_flip(count: int) -> bool:
+    deadline = time.monotonic() + FLIP_TIMEOUT
+    while metrics.registry.percentiles().get("flip", {}).get("count", 0) < count:
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.002)
+    return True
+
+
+async def run(args, capabilities_path: str) -> dict:
+    udev = FakeUdev()
+    daemon, factory = build_daemon(args, udev, capabilities_path)
+    await daemon.start()
+    # Let the startup switch (keyboard absent) finish before measuring.
+    await asyncio.sleep(args.settle + args.hold + 2 * args.ddc_latency / 1000)
+    metrics.registry.reset()
+
+    loop = asyncio.get_running_loop()
+    timeouts = 0
+    for cycle in range(args.cycles):
+        action = "add" if cycle % 2 == 0 else "remove"
+        started = time.perf_counter()
+        if args.hub_delay and action == "add":
+            udev.emit(FakeDevice(action, HUB_PATH, *HUB))
+            loop.call_later(args.hub_delay / 1000, emit_devices, udev, action, args.burst)
+        else:
+            emit_devices(udev, action, args.burst)
+        if args.hub_delay and action == "remove":
+            udev.emit(FakeDevice(action, HUB_PATH, *HUB))
+        if not await wait_for_flip(cycle + 1):
+            timeouts += 1
+        # From the first uevent of the cycle, so a hub's lead time counts.
+        metrics.observe("cycle", time.perf_counter() - started)
+        if args.hub_delay:
+            # Let the devices behind the hub arrive before the next cycle.
+            await asyncio.sleep(max(0.0, started + args.hub_delay / 1000 - time.perf_counter()))
+        # Wait out the hold time so every cycle produces its own flip.
+        await asyncio.sleep(args.hold)
+
+    before = usage()
+    await asyncio.sleep(args.idle)
+    after = usage()
+    daemon.close()
+    udev.close()
+
+    stages = metrics.registry.percentiles()
+    per_hour = 3600.0 / args.idle if args.idle else 0.0
+    return {
+        "config": vars(args),
+        "flip_ms": stages.pop("flip", {}),
+        "cycle_ms": stages.pop("cycle", {}),
+        "stages_ms": stages,
+        "counters": dict(metrics.registry.counters),
+        "flip_timeouts": timeouts,
+        "ddc_commands": {bus: {"reads": b.reads, "writes": b.writes} for bus, b in factory.backends.items()},
+        "idle": {
+            "seconds": args.idle,
+            "cpu_seconds_per_hour": round((after["cpu"] - before["cpu"]) * per_hour, 3),
+            "wakeups_per_hour": round((after["wakeups"] - before["wakeups"]) * per_hour),
+        },
+        "memory": {"rss_kb": rss_kb(), "max_rss_kb": after["max_rss_kb"]},
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=20, help="number of plug/unplug flips")
+    parser.add_argument("--burst", type=int, default=1, help="uevents per flip, including the keyboard")
+    parser.add_argument("--monitors", type=int, default=2, help="number of fake monitors, one per bus")
+    parser.add_argument("--ddc-latency", type=float, default=50.0, help="mean DDC command latency in ms")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability a DDC command fails")
+    parser.add_argument("--input-cache-ttl", type=float, default=60.0, help="input_cache_ttl setting")
+    parser.add_argument("--settle", type=float, default=0.05, help="settle_time setting")
+    parser.add_argument("--hold", type=float, default=0.1, help="switch_hold setting")
+    parser.add_argument("--hub-delay", type=float, default=0.0,
+                        help="ms between the hub's uevent and its devices' (0: no hub uevent)")
+    parser.add_argument("--hub-confirm-timeout", type=float, default=3.0, help="hub_confirm_timeout setting")
+    parser.add_argument("--idle", type=float, default=5.0, help="seconds to measure the idle daemon")
+    parser.add_argument("--seed", type=int, default=0, help="seed for DDC latency jitter and failures")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.getLogger("usb_monitor").addHandler(logging.NullHandler())
+    logging.getLogger("usb_monitor").propagate = False
+    with tempfile.TemporaryDirectory() as tmp:
+        report = asyncio.run(run(args, os.path.join(tmp, "monitors.json")))
+    text = json.dumps(report, indent=4)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return 1 if report["flip_timeouts"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
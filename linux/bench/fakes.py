@@ -0,0 +1,126 @@
+"""Scripted stand-ins for udev and DDC/CI so the daemon runs without hardware.
+
+``FakeUdev`` plays both the pyudev context (``list_devices``) and the
+daemon's detector: ``emit()`` queues a uevent and makes its pipe readable, so
+the event loop sees it exactly like a netlink uevent. ``FakeDdcBackend``
+mimics a monitor with a configurable per-command latency and failure rate.
+Both are deterministic for a given seed.
+"""
+import os
+import random
+import time
+
+import ddc
+
+
+class FakeDevice:
+    """The subset of ``pyudev.Device`` the daemon reads."""
+
+    def __init__(self, action: str, sys_path: str, vid: str = "", pid: str = "", serial: str = "",
+                 subsystem: str = "usb", device_type: str = "usb_device"):
+        self.action = action
+        self.sys_path = sys_path
+        self.subsystem = subsystem
+        self.device_type = device_type
+        self.properties = {"ID_VENDOR_ID": vid, "ID_MODEL_ID": pid, "ID_SERIAL_SHORT": serial}
+
+    def get(self, key: str, default=None):
+        return self.properties.get(key) or default
+
+
+class FakeUdev:
+    """Scripted uevent source; pass it as both context and detector."""
+
+    mode = "udev"
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        self._pending = []
+        self.present = {}
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    def emit(self, device: FakeDevice) -> None:
+        """Queue one uevent and update the enumerable device list."""
+        if device.action == "remove":
+            self.present.pop(device.sys_path, None)
+        else:
+            self.present[device.sys_path] = device
+        self._pending.append(device)
+        os.write(self._write_fd, b"\0")
+
+    def read_pending(self) -> list:
+        try:
+            os.read(self._read_fd, 4096)
+        except BlockingIOError:
+            pass
+        devices, self._pending = self._pending, []
+        return devices
+
+    def list_devices(self, **filters):
+        return list(self.present.values())
+
+    def close(self) -> None:
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class FakeDdcBackend:
+    """A monitor on ``bus`` answering after ``latency`` seconds (±50 % jitter)."""
+
+    name = "fake"
+
+    def __init__(self, bus, latency: float = 0.05, failure_rate: float = 0.0, seed: int = 0):
+        self.bus = str(bus)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(f"{seed}:{bus}")
+        self.value = 0
+        self.reads = 0
+        self.writes = 0
+
+    def _transact(self) -> None:
+        if self.latency:
+            time.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.failure_rate:
+            raise ddc.DdcError(f"Simulated DDC/CI failure on bus {self.bus}")
+
+    def get_vcp(self, code: int) -> tuple:
+        self.reads += 1
+        self._transact()
+        return self.value, 0xFF
+
+    def set_vcp(self, code: int, value: int) -> None:
+        self.writes += 1
+        self._transact()
+        self.value = value
+
+    def get_vcps(self, codes) -> dict:
+        return {code: self.get_vcp(code)[0] for code in codes}
+
+    def set_vcps(self, values: dict) -> None:
+        for code, value in values.items():
+            self.set_vcp(code, value)
+
+    def get_capabilities(self) -> str:
+        self._transact()
+        return "(prot(monitor)type(lcd)vcp(10 12 60(0F 11 12)))"
+
+    def close(self) -> None:
+        pass
+
+
+def backend_factory(latency: float, failure_rate: float, seed: int):
+    """Return a ``SwitchEngine`` backend factory producing fake monitors."""
+    backends = {}
+
+    def create(bus, *args):
+        backend = backends.get(bus)
+        if backend is None:
+            backend = backends[bus] = FakeDdcBackend(bus, latency, failure_rate, seed)
+        return backend
+
+    create.backends = backends
+    return create
@@ -1,31 +1,118 @@
+#!/usr/bin/env python3
+"""Build the tray icon set from the source artwork.
+
+Every ``<name>[_<theme>].png`` in the source directory (``monitor.png``,
+``monitor_light.png``, ``monitor_dark.png``) is trimmed to its visible
+pixels, padded to a square and rendered at each tray size, once per tray
+state: ``connected`` as drawn and ``disconnected`` faded. The transparent
+border is found with ``getbbox()`` on the thresholded alpha band, so the
+pixel scan runs inside Pillow. Source files are processed in parallel, and
+``icons.json`` records every output so the daemon picks a ready-made image
+instead of resizing at runtime.
+
+    python3 linux/crop_image.py linux/src linux/src/icons --sizes 16 22 24 32 48 64
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
 from PIL import Image
 
-def alpha_trim(img_path, output_path, alpha_threshold=10):
-    img = Image.open(img_path).convert("RGBA")
-    pixels = img.load()
-    
-    w, h = img.size
-    top, bottom = None, None
-
-    # Find top
-    for y in range(h):
-        if any(pixels[x, y][3] > alpha_threshold for x in range(w)):
-            top = y
-            break
-
-    # Find bottom
-    for y in reversed(range(h)):
-        if any(pixels[x, y][3] > alpha_threshold for x in range(w)):
-            bottom = y
-            break
-
-    # Find left
-    left = next(x for x in range(w) if any(pixels[x, y][3] > alpha_threshold for y in range(h)))
-    right = next(x for x in reversed(range(w)) if any(pixels[x, y][3] > alpha_threshold for y in range(h)))
-
-    # Crop and save
-    cropped = img.crop((left, top, right + 1, bottom + 1))
-    cropped.save(output_path)
-    print(f"Trimmed and saved as: {output_path}")
-
-alpha_trim("monitor.png", "monitor_trimmed.png")
+THEMES = ("light", "dark")
+DEFAULT_THEME = "default"
+DEFAULT_SIZES = (16, 22, 24, 32, 48, 64, 128)
+# Opacity of the disconnected state relative to the artwork.
+DISCONNECTED_ALPHA = 0.45
+MANIFEST = "icons.json"
+MANIFEST_VERSION = 1
+
+
+def split_name(stem: str) -> tuple:
+    """Return ``(name, theme)`` for a source file stem such as ``monitor_dark``."""
+    name, _, suffix = stem.rpartition("_")
+    if name and suffix in THEMES:
+        return name, suffix
+    return stem, DEFAULT_THEME
+
+
+def alpha_bbox(img: Image.Image, alpha_threshold: int = 10):
+    """Return the box of pixels more opaque than ``alpha_threshold``, or None."""
+    mask = img.getchannel("A").point(lambda a: 255 if a > alpha_threshold else 0)
+    return mask.getbbox()
+
+
+def alpha_trim(img: Image.Image, alpha_threshold: int = 10) -> Image.Image:
+    """Crop ``img`` to its visible pixels."""
+    bbox = alpha_bbox(img, alpha_threshold)
+    return img.crop(bbox) if bbox else img
+
+
+def square(img: Image.Image) -> Image.Image:
+    """Center ``img`` on a transparent square canvas."""
+    side = max(img.size)
+    canvas = Image.new("RGBA", (side, side), (0, 0, 0, 0))
+    canvas.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+    return canvas
+
+
+def fade(img: Image.Image, factor: float) -> Image.Image:
+    faded = img.copy()
+    faded.putalpha(img.getchannel("A").point(lambda a: int(a * factor)))
+    return faded
+
+
+def render(source: str, output_dir: str, sizes, alpha_threshold: int) -> tuple:
+    """Write every size and state of one source file; return its manifest entries."""
+    name, theme = split_name(os.path.splitext(os.path.basename(source))[0])
+    with Image.open(source) as img:
+        base = square(alpha_trim(img.convert("RGBA"), alpha_threshold))
+    states = {"connected": base, "disconnected": fade(base, DISCONNECTED_ALPHA)}
+    entries = {}
+    for state, image in states.items():
+        for size in sizes:
+            file_name = f"{name}-{theme}-{state}-{size}.png"
+            image.resize((size, size), Image.LANCZOS).save(os.path.join(output_dir, file_name), optimize=True)
+            entries.setdefault(state, {})[str(size)] = file_name
+    return name, theme, entries
+
+
+def build(source_dir: str, output_dir: str, sizes=DEFAULT_SIZES, alpha_threshold: int = 10,
+          jobs: int = None) -> dict:
+    """Render every PNG in ``source_dir`` into ``output_dir`` and write the manifest."""
+    sources = sorted(
+        os.path.join(source_dir, entry) for entry in os.listdir(source_dir) if entry.lower().endswith(".png")
+    )
+    if not sources:
+        raise SystemExit(f"No PNG files in {source_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {"version": MANIFEST_VERSION, "sizes": sorted(sizes), "icons": {}}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(render, sources, [output_dir] * len(sources), [sizes] * len(sources),
+                           [alpha_threshold] * len(sources))
+        for source, (name, theme, entries) in zip(sources, results):
+            manifest["icons"].setdefault(name, {})[theme] = entries
+            print(f"{os.path.basename(source)}: {len(entries) * len(sizes)} icons")
+    tmp_path = os.path.join(output_dir, f"{MANIFEST}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, os.path.join(output_dir, MANIFEST))
+    return manifest
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source_dir", help="directory with the source PNG artwork")
+    parser.add_argument("output_dir", help="directory for the icons and icons.json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="square sizes in px")
+    parser.add_argument("--threshold", type=int, default=10, help="alpha at or below this counts as transparent")
+    parser.add_argument("--jobs", type=int, help="worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    manifest = build(args.source_dir, args.output_dir, args.sizes, args.threshold, args.jobs)
+    print(f"Wrote {os.path.join(args.output_dir, MANIFEST)} ({len(manifest['icons'])} icon set(s))")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
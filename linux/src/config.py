@@ -0,0 +1,221 @@
+"""Validated, precompiled settings.
+
+``load()`` turns settings.json into a ``Config``: numbers are
+typed, enumerations, input codes and profile VCP values are checked, device
+IDs are normalized and the rules are compiled into their match index. Anything wrong raises
+``ConfigError`` with a message naming the offending key, so a bad edit can
+be rejected while the previous ``Config`` stays in use.
+"""
+import hashlib
+import json
+import os
+import re
+
+import ddc
+import hotplug
+import rules
+import switching
+
+DETECTION_MODES = ("udev", "poll")
+DDC_BACKENDS = ("native", "ddcutil")
+LOG_FORMATS = ("text", "json")
+TRAY_THEMES = ("light", "dark", "default")
+
+# key: (default, minimum)
+NUMBERS = {
+    "poll_interval": (hotplug.DEFAULT_POLL_INTERVAL, 0.1),
+    "input_cache_ttl": (60.0, 0.0),
+    "settle_time": (0.3, 0.0),
+    "switch_hold": (1.0, 0.0),
+    "ready_timeout": (30.0, 0.0),
+    "reconcile_interval": (300.0, 0.0),
+    "verify_timeout": (2.0, 0.0),
+    "switch_retries": (2, 0),
+    "hub_confirm_timeout": (3.0, 0.0),
+    "history_size": (500, 1),
+}
+
+# Top-level keys besides NUMBERS; anything else is a typo.
+KEYS = {
+    "detection_mode", "ddc_backend", "log_format", "tray_theme", "metrics_textfile", "history_file",
+    "monitor_bus", "monitor", "keyboard_id", "input_connected", "input_disconnected", "monitors", "rules",
+    "profiles", "profile_connected", "profile_disconnected", *NUMBERS,
+}
+
+PATTERN_RE = re.compile(r"^(serial:\S+|[0-9a-f]{4}:\*|[0-9a-f]{4}:[0-9a-f]{4}(:\S+)?)$")
+
+
+class ConfigError(ValueError):
+    """Raised when settings.json cannot be parsed or fails validation."""
+
+
+def _number(raw: dict, key: str) -> float:
+    default, minimum = NUMBERS[key]
+    value = raw.get(key, default)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ConfigError(f"'{key}' must be a number, got {value!r}")
+    if value < minimum:
+        raise ConfigError(f"'{key}' must be at least {minimum:g}, got {value:g}")
+    return value
+
+
+def _choice(raw: dict, key: str, choices: tuple) -> str:
+    value = raw.get(key, choices[0])
+    if value not in choices:
+        raise ConfigError(f"'{key}' must be one of {', '.join(choices)}, got {value!r}")
+    return value
+
+
+def _vcp_value(where: str, value, kind: str = "value", maximum: int = 0xFFFF) -> int:
+    try:
+        number = ddc.parse_vcp_value(value)
+    except (TypeError, ValueError):
+        raise ConfigError(f"{where}: invalid {kind} {value!r}")
+    if not 0 <= number <= maximum:
+        raise ConfigError(f"{where}: {kind} {value!r} out of range")
+    return number
+
+
+def _vcp_maximum(code: int) -> int:
+    # Non-continuous values are read back as their low byte only.
+    return 0xFF if code in ddc.NC_FEATURES else 0xFFFF
+
+
+def _input_code(where: str, value) -> str:
+    _vcp_value(where, value, "input code", _vcp_maximum(ddc.VCP_INPUT_SOURCE))
+    return str(value).strip()
+
+
+def _vcp_code(where: str, key) -> int:
+    """Accept a feature name (``brightness``) or a hex code (``10``, ``0x10``)."""
+    text = str(key).strip().lower()
+    if text in ddc.VCP_FEATURES:
+        return ddc.VCP_FEATURES[text]
+    try:
+        code = int(text[2:] if text.startswith("0x") else text, 16)
+    except ValueError:
+        code = -1
+    if not 0 <= code <= 0xFF or code == ddc.VCP_INPUT_SOURCE:
+        raise ConfigError(f"{where}: invalid VCP feature {key!r}")
+    return code
+
+
+def _profile(where: str, values) -> dict:
+    if not isinstance(values, dict):
+        raise ConfigError(f"{where}: a profile must map VCP features to values")
+    profile = {}
+    for key, value in values.items():
+        code = _vcp_code(where, key)
+        profile[code] = _vcp_value(where, value, maximum=_vcp_maximum(code))
+    return profile
+
+
+def _profiles(raw: dict, displays: list) -> dict:
+    profiles = {
+        name: _profile(f"Profile '{name}'", values) for name, values in (raw.get("profiles") or {}).items()
+    }
+    for display in displays:
+        display.profiles = {
+            name: _profile(f"{display.name}: profile '{name}'", values)
+            for name, values in display.profiles.items()
+        }
+    return profiles
+
+
+def _profile_name(where: str, name, known: set):
+    if name and name not in known:
+        raise ConfigError(f"{where}: unknown profile '{name}'")
+    return name or None
+
+
+def _displays(raw: dict) -> list:
+    displays = switching.load_displays(raw)
+    names = set()
+    for display in displays:
+        if display.name in names:
+            raise ConfigError(f"Monitor name '{display.name}' is used more than once")
+        names.add(display.name)
+        if not display.bus.isdigit():
+            raise ConfigError(f"{display.name}: 'bus' must be an i2c bus number, got {display.bus!r}")
+        display.input_connected = _input_code(display.name, display.input_connected)
+        display.input_disconnected = _input_code(display.name, display.input_disconnected)
+    return displays
+
+
+def _rules(raw: dict, displays: list) -> list:
+    names = {display.name for display in displays}
+    compiled = rules.compile_rules(raw)
+    for rule in compiled:
+        for pattern in rule.patterns:
+            if not PATTERN_RE.match(pattern):
+                raise ConfigError(f"Rule '{rule.name}': invalid device pattern '{pattern}'")
+        if isinstance(rule.inputs, dict):
+            for name, code in rule.inputs.items():
+                if name not in names:
+                    raise ConfigError(f"Rule '{rule.name}': unknown monitor '{name}'")
+            rule.inputs = {name: _input_code(f"Rule '{rule.name}'", code) for name, code in rule.inputs.items()}
+        elif rule.inputs not in (rules.CONNECTED, rules.DISCONNECTED):
+            rule.inputs = _input_code(f"Rule '{rule.name}'", rule.inputs)
+    return compiled
+
+
+class Config:
+    """One validated settings snapshot; it is replaced as a whole, never edited."""
+
+    __slots__ = (
+        "raw", "digest", "displays", "rules", "ruleset", "profiles", "idle_profile", "detection_mode", "ddc_backend",
+        "log_format", "tray_theme", "metrics_textfile", "history_file", *NUMBERS,
+    )
+
+    def __init__(self, raw: dict):
+        if not isinstance(raw, dict):
+            raise ConfigError("settings.json must contain a JSON object")
+        self.raw = raw
+        self.digest = hashlib.sha1(json.dumps(raw, sort_keys=True).encode("utf-8")).hexdigest()
+        unknown = sorted(set(raw) - KEYS)
+        if unknown:
+            raise ConfigError(f"Unknown option(s): {', '.join(unknown)}")
+        try:
+            self.poll_interval = _number(raw, "poll_interval")
+            self.input_cache_ttl = _number(raw, "input_cache_ttl")
+            self.settle_time = _number(raw, "settle_time")
+            self.switch_hold = _number(raw, "switch_hold")
+            self.ready_timeout = _number(raw, "ready_timeout")
+            self.reconcile_interval = _number(raw, "reconcile_interval")
+            self.verify_timeout = _number(raw, "verify_timeout")
+            self.switch_retries = int(_number(raw, "switch_retries"))
+            self.hub_confirm_timeout = _number(raw, "hub_confirm_timeout")
+            self.history_size = int(_number(raw, "history_size"))
+            self.detection_mode = _choice(raw, "detection_mode", DETECTION_MODES)
+            self.ddc_backend = _choice(raw, "ddc_backend", DDC_BACKENDS)
+            self.log_format = _choice(raw, "log_format", LOG_FORMATS)
+            self.tray_theme = _choice(raw, "tray_theme", TRAY_THEMES)
+            self.metrics_textfile = str(raw.get("metrics_textfile") or "") or None
+            self.history_file = os.path.expanduser(str(raw.get("history_file") or "")) or None
+            self.displays = _displays(raw)
+            self.rules = _rules(raw, self.displays)
+            self.profiles = _profiles(raw, self.displays)
+            known = set(self.profiles).union(*(display.profiles for display in self.displays))
+            for rule in self.rules:
+                _profile_name(f"Rule '{rule.name}'", rule.profile, known)
+            self.idle_profile = _profile_name("'profile_disconnected'", raw.get("profile_disconnected"), known)
+        except ConfigError:
+            raise
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ConfigError(f"Malformed settings: {e}")
+        # The daemon seeds and then owns this index when the config is applied.
+        self.ruleset = rules.RuleSet(self.rules)
+
+
+def load(path: str) -> Config:
+    """Read and compile ``path``; raises ``ConfigError`` on any problem."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e}")
+    except ValueError as e:
+        raise ConfigError(f"{path} is not valid JSON: {e}")
+    return Config(raw)
@@ -0,0 +1,197 @@
+"""Local control API over a Unix domain socket.
+
+Clients send one request per line, either as words (``switch connected
+left``) or as a JSON object (``{"cmd": "switch", "args": ["connected"]}``),
+and get one JSON object per line back. Requests run on the daemon's event
+loop and reuse its open DDC connections, so a round trip costs little more
+than the DDC transaction itself. See ``usb_monitor_ctl.py`` for the client.
+"""
+import asyncio
+import json
+import logging
+import os
+
+import config
+import metrics
+import rules
+import switching
+from usb_monitor_ctl import socket_path
+
+logger = logging.getLogger("usb_monitor")
+
+
+class ControlError(Exception):
+    """Raised for a malformed or unknown control request."""
+
+
+def parse_request(line: str) -> tuple:
+    """Return ``(command, args)`` from a text or JSON request line."""
+    line = line.strip()
+    if line.startswith("{"):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            raise ControlError(f"Invalid JSON request: {e}")
+        return str(request.get("cmd", "")), [str(arg) for arg in request.get("args", [])]
+    words = line.split()
+    if not words:
+        raise ControlError("Empty request")
+    return words[0], words[1:]
+
+
+class ControlServer:
+    """Serve status/query/switch/reload/metrics/history requests for a core.Daemon."""
+
+    def __init__(self, daemon, reload=None, path: str = None):
+        self.daemon = daemon
+        self.reload = reload
+        self.path = path or socket_path()
+        self.commands = {
+            "status": self.cmd_status,
+            "query": self.cmd_query,
+            "switch": self.cmd_switch,
+            "reload": self.cmd_reload,
+            "metrics": self.cmd_metrics,
+            "history": self.cmd_history,
+        }
+        self._server = None
+
+    async def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            # The single-instance lock guarantees no live daemon owns it.
+            os.remove(self.path)
+        old_umask = os.umask(0o077)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        finally:
+            os.umask(old_umask)
+        logger.info(f"Control socket listening at {self.path}")
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _handle(self, reader, writer) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.dispatch(line.decode("utf-8", "replace"))
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, line: str) -> dict:
+        try:
+            command, args = parse_request(line)
+            handler = self.commands.get(command)
+            if handler is None:
+                raise ControlError(f"Unknown command '{command}'")
+            reply = await handler(args)
+        except ControlError as e:
+            return {"ok": False, "error": str(e)}
+        except Exception as e:
+            logger.error(f"Control request '{line.strip()}' failed: {e}")
+            return {"ok": False, "error": str(e)}
+        reply.setdefault("ok", True)
+        return reply
+
+    def _display_names(self, names) -> list:
+        displays = self.daemon.engine.displays
+        unknown = [name for name in names if name not in displays]
+        if unknown:
+            raise ControlError(f"Unknown monitor(s): {', '.join(unknown)}")
+        return list(names) or list(displays)
+
+    async def cmd_status(self, args) -> dict:
+        daemon = self.daemon
+        rule = daemon.ruleset.active
+        return {
+            "rule": rule.name if rule else None,
+            "detection": daemon.detector.mode if daemon.detector else None,
+            "devices": len(daemon.present_devices),
+            "displays": {name: display.bus for name, display in daemon.engine.displays.items()},
+            "scheduler": daemon.scheduler.stats(),
+        }
+
+    async def cmd_query(self, args) -> dict:
+        futures = self.daemon.engine.query(self._display_names(args))
+        inputs = {}
+        for name, future in futures.items():
+            try:
+                inputs[name] = await asyncio.wrap_future(future)
+            except Exception as e:
+                inputs[name] = None
+                logger.warning(f"{name}: could not read current input: {e}")
+        return {"ok": all(value is not None for value in inputs.values()), "inputs": inputs}
+
+    async def cmd_switch(self, args) -> dict:
+        if not args:
+            raise ControlError("Usage: switch connected|disconnected|RULE|INPUT_CODE [MONITOR...]")
+        target, names = args[0], self._display_names(args[1:])
+        inputs, matched = target, None
+        for rule in self.daemon.ruleset.rules:
+            if rule.name == target:
+                inputs, matched = rule.inputs, rule
+                break
+        else:
+            if target not in (rules.CONNECTED, rules.DISCONNECTED):
+                try:
+                    config._input_code("switch", target)
+                except config.ConfigError:
+                    raise ControlError(f"Unknown rule or invalid input code: {target!r}")
+        displays = {name: self.daemon.engine.displays[name] for name in names}
+        targets = rules.resolve_targets(inputs, displays)
+        profiles = self.daemon.profiles_for(matched, targets) if matched else None
+        batch = await self.daemon.switch(targets, switching.MANUAL, profiles=profiles, trigger="control")
+        return {
+            "ok": all(result.ok for result in batch.results),
+            "results": {
+                result.name: {
+                    "input": result.input_code,
+                    "ok": result.ok,
+                    "skipped": result.skipped,
+                    "superseded": result.superseded,
+                    "adjusted": result.adjusted,
+                    "error": str(result.error) if result.error else None,
+                    "ms": round(result.duration * 1000, 1),
+                }
+                for result in batch.results
+            },
+            "total_ms": round(batch.total * 1000, 1),
+        }
+
+    async def cmd_metrics(self, args) -> dict:
+        return {"text": self.daemon.export_metrics(), "stages": metrics.registry.percentiles()}
+
+    async def cmd_history(self, args) -> dict:
+        history = self.daemon.history
+        if history is None:
+            raise ControlError("Switch history is not enabled")
+        try:
+            limit = int(args[0]) if args else 20
+        except ValueError:
+            raise ControlError("Usage: history [COUNT]")
+        return {
+            "stats": history.stats(),
+            "events": [event.as_dict() for event in history.events(limit)],
+            "summary": history.summary(),
+        }
+
+    async def cmd_reload(self, args) -> dict:
+        if self.reload is None:
+            raise ControlError("Reload is not supported")
+        try:
+            await self.reload()
+        except config.ConfigError as e:
+            raise ControlError(f"Invalid settings, keeping the previous configuration: {e}")
+        return {}
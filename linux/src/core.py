@@ -0,0 +1,511 @@
+"""asyncio core of the daemon.
+
+Everything that used to run on its own thread now runs on one event loop:
+the udev monitor socket is registered with ``add_reader``, the debounce
+deadline, reconcile and poll intervals are loop timers, and DDC commands run
+on the per-bus workers of the switching engine and are awaited through
+futures. Other threads (the tray, settings popups) hand work to the loop
+with ``call_threadsafe``.
+"""
+import asyncio
+import logging
+import time
+
+import hotplug
+import metrics
+import presence
+import readiness
+import rules
+import switching
+import topology
+from scheduler import UNSET
+
+logger = logging.getLogger("usb_monitor")
+
+
+def log_switch_results(batch) -> None:
+    results = batch.results
+    for result in results:
+        fields = {
+            "monitor": result.name,
+            "input": result.input_code,
+            "duration_ms": round(result.duration * 1000, 1),
+        }
+        if result.superseded:
+            logger.info(f"{result.name}: switch to {result.input_code} superseded by a newer command",
+                        extra=dict(fields, event="switch_superseded"))
+        elif not result.ok:
+            logger.info(f"{result.name}: failed to switch input to {result.input_code}: {result.error}",
+                        extra=dict(fields, event="switch_failed"))
+        elif result.skipped:
+            logger.info(f"{result.name}: input already {result.input_code}, skipping switch",
+                        extra=dict(fields, event="switch_skipped"))
+        else:
+            retries = f" after {result.retries} rewrite(s)" if result.retries else ""
+            logger.info(f"{result.name}: switched input to {result.input_code} in "
+                        f"{result.duration * 1000:.0f} ms{retries}", extra=dict(fields, event="switch"))
+        if result.adjusted:
+            logger.info(f"{result.name}: applied {result.adjusted} profile setting(s)",
+                        extra=dict(fields, event="profile"))
+    if len(results) > 1:
+        failed = sum(1 for result in results if not result.ok)
+        logger.info(f"Switched {len(results) - failed}/{len(results)} monitors in {batch.total * 1000:.0f} ms",
+                    extra={"event": "switch_batch", "duration_ms": round(batch.total * 1000, 1)})
+
+
+# History trigger names for switches not caused by a rule.
+TRIGGERS = {switching.CONTROL: "control", switching.MANUAL: "manual", switching.AUTOMATIC: "automatic"}
+
+
+def rule_name(rule):
+    return rule.name if rule is not None else None
+
+
+class Daemon:
+    """Detection, debouncing and switching driven by a single event loop."""
+
+    def __init__(self, context, present_devices, ruleset, scheduler, engine, input_cache,
+                 detection_mode: str = "udev", poll_interval: float = hotplug.DEFAULT_POLL_INTERVAL,
+                 reconcile_interval: float = 300.0, ready_timeout: float = 30.0, metrics_textfile: str = None,
+                 detector=None, profiles: dict = None, idle_profile: str = None, state=None,
+                 config_digest: str = None, hub_confirm_timeout: float = 3.0, history=None):
+        self.context = context
+        self.present_devices = present_devices
+        self.ruleset = ruleset
+        self.scheduler = scheduler
+        self.engine = engine
+        self.input_cache = input_cache
+        self.detection_mode = detection_mode
+        self.poll_interval = poll_interval
+        self.reconcile_interval = reconcile_interval
+        self.ready_timeout = ready_timeout
+        self.metrics_textfile = metrics_textfile
+        self.profiles = profiles or {}
+        # Profile applied while no rule is active.
+        self.idle_profile = idle_profile
+        self.loop = None
+        # A prebuilt detector (e.g. a scripted event source) replaces udev/polling.
+        self.detector = detector
+        self._stopped = None
+        self._scheduler_timer = None
+        self._reconcile_timer = None
+        self._services = []
+        self._event_time = None
+        self._change_started = None
+        self.pending_switches = 0
+        # Optional uevent_trace.TraceRecorder for --capture and replay.
+        self.tracer = None
+        # Optional state.StateFile; with it a restart only switches what changed.
+        self.state = state
+        self.config_digest = config_digest
+        # Input each monitor was last confirmed on.
+        self.inputs = {}
+        # Rule-matching devices are expected as soon as their hub reappears;
+        # 0 waits for the device itself.
+        self.topology = topology.TopologyIndex()
+        # Optional history.History of switch outcomes.
+        self.history = history
+        self.hub_confirm_timeout = hub_confirm_timeout
+        self._predicted = {}
+
+    def add_service(self, service) -> None:
+        """Run ``service`` alongside the daemon; it needs async start() and close()."""
+        self._services.append(service)
+
+    # -- thread-safe entry points -------------------------------------------
+
+    def call_threadsafe(self, callback, *args) -> None:
+        """Run ``callback(*args)`` on the loop from any thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop_threadsafe(self) -> None:
+        self.call_threadsafe(self.stop)
+
+    def run_blocking_threadsafe(self, fn) -> None:
+        """Run a blocking ``fn`` (e.g. a Tk popup) on the loop's executor."""
+        self.call_threadsafe(lambda: self.loop.run_in_executor(None, fn))
+
+    # -- switching ----------------------------------------------------------
+
+    def targets_for(self, rule) -> dict:
+        """Return the input code per monitor for the winning rule (or none)."""
+        inputs = rule.inputs if rule is not None else rules.DISCONNECTED
+        return rules.resolve_targets(inputs, self.engine.displays)
+
+    def profiles_for(self, rule, targets: dict) -> dict:
+        """Return the profile values per monitor that go with ``rule``."""
+        profile = rule.profile if rule is not None else self.idle_profile
+        return rules.resolve_profiles(profile, self.profiles, targets, self.engine.displays)
+
+    def switch(self, targets: dict, priority: int = switching.AUTOMATIC, started: float = None,
+               profiles: dict = None, trigger: str = None) -> asyncio.Future:
+        """Queue a switch on the bus workers; the returned future resolves to the batch.
+
+        ``started`` is the perf_counter time of the uevent that caused the
+        switch, used for the end-to-end ``flip`` latency. ``trigger`` names
+        the cause in the switch history.
+        """
+        trigger = trigger or TRIGGERS.get(priority, "other")
+        future = self.loop.create_future()
+        if self.tracer is not None:
+            self.tracer.switch(targets, priority)
+        batch = self.engine.submit(targets, priority, profiles)
+        self.pending_switches += 1
+
+        def resolve():
+            self.pending_switches -= 1
+            if self.tracer is not None:
+                self.tracer.results(batch)
+            self._record_inputs(batch)
+            if self.history is not None:
+                self.history.record(batch, trigger)
+            if started is not None:
+                metrics.observe("flip", time.perf_counter() - started)
+            if self.metrics_textfile:
+                self.loop.run_in_executor(None, self.write_metrics)
+            if not future.done():
+                future.set_result(batch)
+
+        def done(batch):
+            log_switch_results(batch)
+            self.loop.call_soon_threadsafe(resolve)
+
+        batch.add_done_callback(done)
+        return future
+
+    def _record_inputs(self, batch) -> None:
+        for result in batch.results:
+            if result.superseded:
+                continue
+            if result.ok:
+                self.inputs[result.name] = result.input_code
+            else:
+                self.inputs.pop(result.name, None)
+        self.save_state()
+
+    def save_state(self) -> None:
+        """Persist the committed rule and monitor inputs off the loop."""
+        if self.state is None or self.scheduler.committed is UNSET:
+            return
+        inputs = {name: code for name, code in self.inputs.items() if name in self.engine.displays}
+        self.loop.run_in_executor(
+            None, self.state.save, self.config_digest, rule_name(self.scheduler.committed), inputs,
+            self.present_devices.keys(),
+        )
+
+    def switch_state(self, connected: bool, priority: int = switching.MANUAL) -> asyncio.Future:
+        inputs = rules.CONNECTED if connected else rules.DISCONNECTED
+        return self.switch(rules.resolve_targets(inputs, self.engine.displays), priority)
+
+    # -- detection ----------------------------------------------------------
+
+    def _propose(self) -> None:
+        self.scheduler.propose(self.ruleset.active)
+        if self.scheduler.deadline is None:
+            self._change_started = None
+        elif self._change_started is None:
+            self._change_started = self._event_time
+        self._arm_scheduler()
+
+    def _arm_scheduler(self) -> None:
+        if self._scheduler_timer is not None:
+            self._scheduler_timer.cancel()
+            self._scheduler_timer = None
+        timeout = self.scheduler.timeout()
+        if timeout is not None:
+            self._scheduler_timer = self.loop.call_later(timeout, self._on_scheduler_due)
+
+    def _on_scheduler_due(self) -> None:
+        self._scheduler_timer = None
+        if not self.scheduler.is_due():
+            self._arm_scheduler()
+            return
+        rule = self.scheduler.commit()
+        logger.info(f"Active rule: {rule_name(rule) or 'none'}", extra={"event": "rule"})
+        if self.tracer is not None:
+            self.tracer.rule(rule)
+        started, self._change_started = self._change_started, None
+        targets = self.targets_for(rule)
+        self.switch(targets, started=started, profiles=self.profiles_for(rule, targets),
+                    trigger=f"rule:{rule_name(rule) or 'none'}")
+
+    def handle_device(self, device) -> None:
+        # Hotplug and display power events may mean the input changed.
+        self.input_cache.invalidate()
+        if device.subsystem == "drm":
+            self.engine.reset()
+            return
+        added, removed = self.present_devices.apply(device)
+        if device.action in presence.REMOVE_ACTIONS:
+            self._cancel_prediction(device.sys_path)
+            removed += self._withdraw_behind(device.sys_path)
+        else:
+            if self._cancel_prediction(device.sys_path):
+                metrics.inc("predictions_confirmed_total")
+            # Only an added hub brings its devices back: a hub's unbind comes
+            # after the devices behind it are already gone.
+            if device.action == "add":
+                keys = presence.device_keys(device)
+                if keys:
+                    self.topology.learn(device.sys_path, keys, self.ruleset.watches(keys))
+                added += self._predict_behind(device.sys_path)
+        # The first key of a device is its VID:PID.
+        if added:
+            logger.info(f"USB device added: {added[0]}", extra={"event": "device_added", "device": added[0]})
+        if removed:
+            logger.info(f"USB device removed: {removed[0]}", extra={"event": "device_removed", "device": removed[0]})
+        if self.ruleset.apply(added, removed):
+            self._propose()
+
+    def _learn_present(self) -> None:
+        for sys_path, keys in self.present_devices.items():
+            self.topology.learn(sys_path, keys, self.ruleset.watches(keys))
+
+    def _predict_behind(self, hub: str) -> tuple:
+        """Mark the known devices behind a newly added hub present; return the new keys."""
+        added = ()
+        if self.hub_confirm_timeout <= 0:
+            return added
+        for sys_path, keys in self.topology.behind(hub):
+            if self.present_devices.has_path(sys_path):
+                continue
+            added += self.present_devices.add(sys_path, keys)
+            self._predicted[sys_path] = self.loop.call_later(
+                self.hub_confirm_timeout, self._on_prediction_expired, sys_path
+            )
+            metrics.inc("predictions_total")
+            logger.info(f"Hub {hub} appeared, expecting {keys[0]} behind it",
+                        extra={"event": "device_predicted", "device": keys[0]})
+        return added
+
+    def _withdraw_behind(self, hub: str) -> tuple:
+        """Drop unconfirmed predictions behind a removed hub; return the keys that went away."""
+        removed = ()
+        for sys_path, _ in self.topology.behind(hub):
+            if self._cancel_prediction(sys_path):
+                removed += self.present_devices.discard(sys_path)
+        return removed
+
+    def _cancel_prediction(self, sys_path: str) -> bool:
+        timer = self._predicted.pop(sys_path, None)
+        if timer is None:
+            return False
+        timer.cancel()
+        return True
+
+    def _on_prediction_expired(self, sys_path: str) -> None:
+        del self._predicted[sys_path]
+        removed = self.present_devices.discard(sys_path)
+        metrics.inc("predictions_withdrawn_total")
+        logger.info(f"Expected device at {sys_path} did not appear, withdrawing it",
+                    extra={"event": "prediction_withdrawn"})
+        if self.ruleset.apply((), removed):
+            self._propose()
+
+    def _on_readable(self) -> None:
+        self._event_time = time.perf_counter()
+        try:
+            devices = self.detector.read_pending()
+        except OSError as e:
+            self._event_time = None
+            logger.warning(f"Lost uevents ({e}), re-enumerating USB devices")
+            self._recover_lost_uevents()
+            return
+        metrics.observe("uevent", time.perf_counter() - self._event_time)
+        for device in devices:
+            metrics.inc("uevents_total")
+            if self.tracer is not None:
+                self.tracer.uevent(device)
+            with metrics.span("presence"):
+                self.handle_device(device)
+        self._event_time = None
+
+    def _recover_lost_uevents(self) -> None:
+        # Any of them may have been a monitor hotplug or the device a prediction waits for.
+        self.engine.reset()
+        for sys_path in list(self._predicted):
+            self._cancel_prediction(sys_path)
+        self.resync()
+
+    def list_usb_devices(self):
+        return self.context.list_devices(subsystem="usb", DEVTYPE="usb_device")
+
+    def resync(self, warn: bool = True) -> None:
+        """Re-enumerate USB devices and propose a switch if the winner changed."""
+        if self._predicted:
+            # A hub is still enumerating; the next pass catches up.
+            return
+        if self.present_devices.reconcile(self.list_usb_devices(), warn=warn):
+            self._learn_present()
+            self.input_cache.invalidate()
+            previous = self.ruleset.active
+            self.ruleset.seed(self.present_devices.keys())
+            if self.ruleset.active is not previous:
+                self._propose()
+
+    def _on_reconcile_timer(self) -> None:
+        poll = self.detector.mode == "poll"
+        self.resync(warn=not poll)
+        interval = self.poll_interval if poll else self.reconcile_interval
+        if interval > 0:
+            self._reconcile_timer = self.loop.call_later(interval, self._on_reconcile_timer)
+
+    def export_metrics(self) -> str:
+        """Return Prometheus text for the registry plus scheduler counters."""
+        for name, value in self.scheduler.stats().items():
+            metrics.set_gauge(f"scheduler_{name}", value)
+        metrics.set_gauge("present_devices", len(self.present_devices))
+        return metrics.registry.prometheus()
+
+    def write_metrics(self) -> None:
+        try:
+            self.export_metrics()
+            metrics.registry.write_textfile(self.metrics_textfile)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self.metrics_textfile}: {e}")
+
+    def reconfigure(self, config) -> None:
+        """Swap in a new config.Config, keeping device presence, caches and queued work."""
+        if (config.detection_mode, config.poll_interval) != (self.detection_mode, self.poll_interval):
+            logger.info("Detection mode changes take effect after a restart")
+        committed = self.scheduler.committed
+        if committed is not UNSET:
+            targets = self.targets_for(committed)
+            committed_plan = (targets, self.profiles_for(committed, targets))
+        self.engine.set_displays(config.displays, config.ddc_backend)
+        self.engine.verify_timeout = config.verify_timeout
+        self.engine.max_retries = config.switch_retries
+        self.scheduler.settle = config.settle_time
+        self.scheduler.hold = config.switch_hold
+        self.input_cache.ttl = config.input_cache_ttl
+        self.reconcile_interval = config.reconcile_interval
+        self.hub_confirm_timeout = config.hub_confirm_timeout
+        self.metrics_textfile = config.metrics_textfile
+        if self.history is not None:
+            self.history.resize(config.history_size)
+            self.history.path = config.history_file
+        self.profiles = config.profiles
+        self.idle_profile = config.idle_profile
+        self.config_digest = config.digest
+        self.ruleset = config.ruleset
+        self.ruleset.seed(self.present_devices.keys())
+        self.topology.refresh(self.ruleset.watches)
+        self._learn_present()
+        active = self.ruleset.active
+        if committed is not UNSET and rule_name(committed) == rule_name(active):
+            # The same rule still wins; switch at once only if its inputs changed.
+            targets = self.targets_for(active)
+            unchanged = (targets, self.profiles_for(active, targets)) == committed_plan
+            self.scheduler.committed = active if unchanged else UNSET
+        self._propose()
+        self.save_state()
+
+    # -- lifecycle ----------------------------------------------------------
+
+    async def wait_until_ready(self, buses=None) -> None:
+        """Wait for udev and the i2c buses off the loop; ``ready_timeout`` 0 skips this."""
+        if self.ready_timeout > 0:
+            buses = self.engine.buses() if buses is None else buses
+            await self.loop.run_in_executor(None, readiness.wait_until_ready, buses, self.ready_timeout)
+
+    def load_state(self):
+        """Return the saved snapshot if it was written with the current settings."""
+        snapshot = self.state.load() if self.state is not None else None
+        if snapshot is not None and snapshot.get("config") != self.config_digest:
+            logger.info("Settings changed since the last run, ignoring saved state")
+            return None
+        return snapshot
+
+    def _resume(self, snapshot: dict) -> bool:
+        """Adopt the saved state if the same rule still wins; switch only stale monitors."""
+        rule = self.ruleset.active
+        if rule_name(rule) != snapshot.get("rule"):
+            logger.info(f"Active rule changed while stopped ({snapshot.get('rule') or 'none'} -> "
+                        f"{rule_name(rule) or 'none'})")
+            return False
+        self.inputs = {
+            name: code for name, code in (snapshot.get("inputs") or {}).items() if name in self.engine.displays
+        }
+        targets = self.targets_for(rule)
+        stale = {name: code for name, code in targets.items() if self.inputs.get(name) != code}
+        self.scheduler.committed = rule
+        if self.tracer is not None:
+            self.tracer.rule(rule)
+        drift = len(set(snapshot.get("devices") or ()) ^ self.present_devices.keys())
+        logger.info(f"Restored state: rule {rule_name(rule) or 'none'}, "
+                    f"{len(targets) - len(stale)}/{len(targets)} monitor(s) already on target, "
+                    f"{drift} device key(s) changed while stopped", extra={"event": "state_restored"})
+        if stale:
+            self.switch(stale, profiles=self.profiles_for(rule, stale), trigger="restart")
+        return True
+
+    async def start(self) -> None:
+        """Wait for the system to be ready and begin watching for devices."""
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        snapshot = self.load_state()
+        # After a warm restart the monitors are already set up; only udev must have settled.
+        await self.wait_until_ready(() if snapshot is not None else None)
+        # Start listening before the first enumeration so no uevent slips in between.
+        if self.detector is None:
+            self.detector = hotplug.create_detector(self.context, self.detection_mode, self.poll_interval)
+        logger.info(f"Detection mode: {self.detector.mode}")
+        if self.detector.fileno() is not None:
+            self.loop.add_reader(self.detector.fileno(), self._on_readable)
+        devices = list(self.list_usb_devices())
+        if self.tracer is not None:
+            self.tracer.seed(devices)
+        self.present_devices.seed(devices)
+        self.ruleset.seed(self.present_devices.keys())
+        self._learn_present()
+        if snapshot is None or not self._resume(snapshot):
+            self._propose()
+        interval = self.poll_interval if self.detector.mode == "poll" else self.reconcile_interval
+        if interval > 0:
+            self._reconcile_timer = self.loop.call_later(interval, self._on_reconcile_timer)
+
+    def stop(self) -> None:
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def run(self) -> None:
+        """Run until stop() is called."""
+        await self.start()
+        try:
+            for service in self._services:
+                try:
+                    await service.start()
+                except Exception as e:
+                    # Switching does not depend on any of them.
+                    logger.error(f"{type(service).__name__} failed to start, running without it: {e}")
+            await self._stopped.wait()
+        finally:
+            for service in reversed(self._services):
+                await service.close()
+            self.close()
+
+    async def run_once(self) -> bool:
+        """Switch once for the devices present now; True if every monitor succeeded."""
+        self.loop = asyncio.get_running_loop()
+        await self.wait_until_ready()
+        self.present_devices.seed(self.list_usb_devices())
+        self.ruleset.seed(self.present_devices.keys())
+        rule = self.ruleset.active
+        logger.info(f"Active rule: {rule_name(rule) or 'none'}")
+        targets = self.targets_for(rule)
+        batch = await self.switch(targets, profiles=self.profiles_for(rule, targets))
+        self.engine.shutdown()
+        return all(result.ok for result in batch.results)
+
+    def close(self) -> None:
+        for timer in (self._scheduler_timer, self._reconcile_timer, *self._predicted.values()):
+            if timer is not None:
+                timer.cancel()
+        if self.detector is not None and self.detector.fileno() is not None:
+            self.loop.remove_reader(self.detector.fileno())
+        self.engine.shutdown()
+        if self.tracer is not None:
+            self.tracer.close()
+        if self.history is not None:
+            self.history.save()
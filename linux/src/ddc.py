@@ -0,0 +1,344 @@
+"""DDC/CI backends used to read and write monitor VCP features.
+
+``I2cBackend`` talks to ``/dev/i2c-N`` directly and keeps the device open
+between commands. ``DdcutilBackend`` shells out to ``ddcutil`` and is kept as
+a fallback for setups where the native path does not work.
+"""
+import fcntl
+import logging
+import os
+import re
+import stat
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger("usb_monitor")
+
+VCP_INPUT_SOURCE = 0x60
+
+# Features a display profile may set, by the names settings.json accepts.
+VCP_FEATURES = {
+    "brightness": 0x10,
+    "contrast": 0x12,
+    "color_preset": 0x14,
+    "volume": 0x62,
+}
+
+# Non-continuous features: the value is an enumeration held in the low byte
+# (SL). Some monitors put unrelated data in the high byte (SH).
+NC_FEATURES = {VCP_INPUT_SOURCE, VCP_FEATURES["color_preset"]}
+
+I2C_SLAVE = 0x0703
+I2C_MAJOR = 89
+DDC_ADDR = 0x37
+HOST_ADDR = 0x51
+# Checksums start from the destination address as it appears on the wire.
+WRITE_CHECKSUM_SEED = DDC_ADDR << 1
+READ_CHECKSUM_SEED = 0x50
+
+GET_VCP_REQUEST = 0x01
+GET_VCP_REPLY = 0x02
+SET_VCP_REQUEST = 0x03
+CAPABILITIES_REQUEST = 0xF3
+CAPABILITIES_REPLY = 0xE3
+# Capabilities replies carry at most 32 data bytes plus a 6 byte envelope.
+CAPABILITIES_FRAGMENT = 38
+
+# Minimum delays from the DDC/CI spec: wait before reading a reply, and
+# between the end of one command and the start of the next.
+REPLY_DELAY = 0.04
+COMMAND_GAP = 0.05
+
+
+class DdcError(Exception):
+    """Raised when a DDC/CI transaction fails."""
+
+
+def parse_vcp_value(value) -> int:
+    """Parse an input code given as ``15``, ``"15"``, ``"0x0f"`` or ``"x0f"``."""
+    if isinstance(value, int):
+        return value
+    text = str(value).strip().lower()
+    if text.startswith("x"):
+        return int(text[1:], 16)
+    return int(text, 0)
+
+
+def parse_terse_line(line: str):
+    """Parse ``ddcutil --terse getvcp`` output into ``(code, value, maximum)``.
+
+    Lines look like "VCP 60 SNC x0f" or "VCP 10 C 50 100"; anything else
+    (e.g. an unsupported feature) returns None.
+    """
+    fields = line.split()
+    if len(fields) < 4 or fields[0] != "VCP":
+        return None
+    code = int(fields[1], 16)
+    if fields[2] == "SNC":
+        return code, parse_vcp_value(fields[3]), 0
+    if fields[2] == "C" and len(fields) >= 5:
+        return code, int(fields[3]), int(fields[4])
+    return None
+
+
+def checksum(seed: int, data) -> int:
+    for byte in data:
+        seed ^= byte
+    return seed
+
+
+def build_request(payload: bytes) -> bytes:
+    """Frame a DDC/CI request: source address, length, payload and checksum."""
+    frame = bytes([HOST_ADDR, 0x80 | len(payload)]) + payload
+    return frame + bytes([checksum(WRITE_CHECKSUM_SEED, frame)])
+
+
+def parse_vcp_reply(reply: bytes, code: int) -> tuple:
+    """Validate a Get VCP Feature reply and return ``(current, maximum)``.
+
+    The current value of a non-continuous feature is its low byte only, as
+    ddcutil reports it.
+    """
+    if len(reply) < 11:
+        raise DdcError(f"Short VCP reply: {reply.hex()}")
+    if checksum(READ_CHECKSUM_SEED, reply[:10]) != reply[10]:
+        raise DdcError(f"Bad VCP reply checksum: {reply.hex()}")
+    if reply[1] & 0x7F != 8 or reply[2] != GET_VCP_REPLY:
+        raise DdcError(f"Unexpected VCP reply: {reply.hex()}")
+    if reply[3] != 0:
+        raise DdcError(f"Monitor does not support VCP 0x{code:02x}")
+    if reply[4] != code:
+        raise DdcError(f"VCP reply for 0x{reply[4]:02x}, expected 0x{code:02x}")
+    current = reply[9] if code in NC_FEATURES else (reply[8] << 8) | reply[9]
+    return current, (reply[6] << 8) | reply[7]
+
+
+def parse_capabilities_reply(reply: bytes, offset: int) -> bytes:
+    """Validate one capabilities reply fragment and return its data bytes."""
+    length = reply[1] & 0x7F if len(reply) > 1 else 0
+    if length < 3 or len(reply) < length + 3:
+        raise DdcError(f"Short capabilities reply: {reply.hex()}")
+    if checksum(READ_CHECKSUM_SEED, reply[:length + 2]) != reply[length + 2]:
+        raise DdcError(f"Bad capabilities reply checksum: {reply.hex()}")
+    if reply[2] != CAPABILITIES_REPLY or (reply[3] << 8) | reply[4] != offset:
+        raise DdcError(f"Unexpected capabilities reply: {reply.hex()}")
+    return reply[5:length + 2]
+
+
+class I2cBackend:
+    """In-process DDC/CI over an I2C character device.
+
+    The device is opened on first use and kept open across commands. Any
+    non i2c-dev path (a pty or pipe standing in for a monitor) skips the
+    I2C_SLAVE ioctl, which makes the backend easy to drive from tests.
+    """
+
+    name = "native"
+
+    def __init__(self, bus, device_path: str = None, reply_delay: float = REPLY_DELAY,
+                 command_gap: float = COMMAND_GAP):
+        self.bus = str(bus)
+        self.device_path = device_path or f"/dev/i2c-{self.bus}"
+        self.reply_delay = reply_delay
+        self.command_gap = command_gap
+        self._fd = None
+        self._lock = threading.Lock()
+        self._last_command = 0.0
+
+    def open(self) -> None:
+        if self._fd is not None:
+            return
+        fd = os.open(self.device_path, os.O_RDWR)
+        try:
+            st = os.fstat(fd)
+            if stat.S_ISCHR(st.st_mode) and os.major(st.st_rdev) == I2C_MAJOR:
+                fcntl.ioctl(fd, I2C_SLAVE, DDC_ADDR)
+        except OSError:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _wait_gap(self) -> None:
+        delay = self._last_command + self.command_gap - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _transaction(self, request: bytes, reply_length: int = 0) -> bytes:
+        self.open()
+        self._wait_gap()
+        try:
+            os.write(self._fd, request)
+            reply = b""
+            if reply_length:
+                time.sleep(self.reply_delay)
+                reply = os.read(self._fd, reply_length)
+        except OSError:
+            # The monitor may have been power cycled; reopen on next use.
+            self.close()
+            raise
+        finally:
+            self._last_command = time.monotonic()
+        return reply
+
+    def _set(self, code: int, value: int) -> None:
+        self._transaction(build_request(bytes([SET_VCP_REQUEST, code, (value >> 8) & 0xFF, value & 0xFF])))
+
+    def _get(self, code: int) -> tuple:
+        return parse_vcp_reply(self._transaction(build_request(bytes([GET_VCP_REQUEST, code])), 11), code)
+
+    def set_vcp(self, code: int, value: int) -> None:
+        with self._lock:
+            self._set(code, value)
+
+    def get_vcp(self, code: int) -> tuple:
+        with self._lock:
+            return self._get(code)
+
+    def set_vcps(self, values: dict) -> None:
+        """Write several features in one pass over the open bus."""
+        with self._lock:
+            for code, value in values.items():
+                self._set(code, value)
+
+    def get_vcps(self, codes) -> dict:
+        """Read several features in one pass; unreadable ones are left out."""
+        values = {}
+        with self._lock:
+            for code in codes:
+                try:
+                    values[code] = self._get(code)[0]
+                except (OSError, DdcError) as e:
+                    logger.debug(f"Could not read VCP {code:02x} on bus {self.bus}: {e}")
+        return values
+
+    def get_capabilities(self) -> str:
+        """Read the full capabilities string, one fragment at a time."""
+        data = b""
+        with self._lock:
+            while True:
+                offset = len(data)
+                request = build_request(bytes([CAPABILITIES_REQUEST, offset >> 8, offset & 0xFF]))
+                reply = self._transaction(request, CAPABILITIES_FRAGMENT)
+                fragment = parse_capabilities_reply(reply, offset)
+                if not fragment:
+                    break
+                data += fragment
+        return data.rstrip(b"\x00").decode("ascii", "replace")
+
+
+class DdcutilBackend:
+    """DDC/CI through the ``ddcutil`` command line tool."""
+
+    name = "ddcutil"
+
+    def __init__(self, bus, command: str = "ddcutil"):
+        self.bus = str(bus)
+        self.command = command
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def set_vcp(self, code: int, value: int) -> None:
+        self.set_vcps({code: value})
+
+    def get_vcp(self, code: int) -> tuple:
+        result = subprocess.run(
+            [self.command, "--bus", self.bus, "--terse", "getvcp", f"{code:02x}"],
+            check=True, capture_output=True, text=True,
+        )
+        parsed = parse_terse_line(result.stdout.strip())
+        if parsed is None:
+            raise DdcError(f"Unexpected ddcutil output: {result.stdout.strip()}")
+        return parsed[1:]
+
+    def set_vcps(self, values: dict) -> None:
+        """Write every feature with a single ``ddcutil setvcp`` invocation."""
+        pairs = []
+        for code, value in values.items():
+            pairs += [f"{code:02x}", str(value)]
+        subprocess.run([self.command, "--bus", self.bus, "setvcp", *pairs], check=True)
+
+    def get_vcps(self, codes) -> dict:
+        """Read every feature with a single ``ddcutil getvcp`` invocation."""
+        result = subprocess.run(
+            [self.command, "--bus", self.bus, "--terse", "getvcp", *(f"{code:02x}" for code in codes)],
+            capture_output=True, text=True,
+        )
+        values = {}
+        for line in result.stdout.splitlines():
+            parsed = parse_terse_line(line)
+            if parsed is not None:
+                values[parsed[0]] = parsed[1]
+        return values
+
+    def get_capabilities(self) -> str:
+        result = subprocess.run(
+            [self.command, "--bus", self.bus, "--verbose", "capabilities"],
+            check=True, capture_output=True, text=True,
+        )
+        match = re.search(r"capabilities string:\s*(\S.*)", result.stdout, re.IGNORECASE)
+        if not match:
+            raise DdcError("ddcutil did not report a capabilities string")
+        return match.group(1).strip()
+
+
+class InputStateCache:
+    """Last known VCP 0x60 value per monitor, trusted for ``ttl`` seconds.
+
+    Entries are dropped on hotplug and display events, since the monitor or
+    another host may have changed the input behind our back.
+    """
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, stamp = entry
+        if time.monotonic() - stamp > self.ttl:
+            self._entries.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value: int) -> None:
+        if self.ttl > 0:
+            self._entries[key] = (value, time.monotonic())
+
+    def invalidate(self, key=None) -> None:
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+def create_backend(bus, name: str = "native", ddcutil_command: str = "ddcutil", quirks: dict = None):
+    """Return a DDC backend for ``bus``, falling back to ddcutil if needed.
+
+    ``quirks`` may override the native backend's ``reply_delay`` and
+    ``command_gap`` for monitors that need more time than the spec minimum.
+    """
+    quirks = quirks or {}
+    if name == "native":
+        backend = I2cBackend(
+            bus,
+            reply_delay=quirks.get("reply_delay", REPLY_DELAY),
+            command_gap=quirks.get("command_gap", COMMAND_GAP),
+        )
+        try:
+            backend.open()
+            return backend
+        except OSError as e:
+            logger.warning(f"Cannot open {backend.device_path}, falling back to ddcutil: {e}")
+    return DdcutilBackend(bus, ddcutil_command)
@@ -0,0 +1,244 @@
+"""Monitor discovery by EDID and a persistent capabilities cache.
+
+Monitors are found by walking the DRM connectors in sysfs, which is cheap and
+does not touch the I2C bus. Each connector's EDID identifies the monitor
+(manufacturer, model and serial) and its ``ddc`` link gives the current
+``/dev/i2c-N`` bus, so settings can name a monitor instead of a bus number.
+
+Capabilities (supported input codes and timing quirks) are probed over DDC
+once per monitor and cached by EDID hash, so later starts skip the probe.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger("usb_monitor")
+
+DRM_CLASS = "/sys/class/drm"
+
+
+class MonitorInfo:
+    """Identity and current bus of a connected monitor."""
+
+    __slots__ = ("connector", "bus", "manufacturer", "product_code", "model", "serial", "edid_hash")
+
+    def __init__(self, connector, bus, manufacturer, product_code, model, serial, edid_hash):
+        self.connector = connector
+        self.bus = bus
+        self.manufacturer = manufacturer
+        self.product_code = product_code
+        self.model = model
+        self.serial = serial
+        self.edid_hash = edid_hash
+
+    @property
+    def key(self) -> str:
+        """Human readable ``MFG:model:serial`` identifier used in settings."""
+        return f"{self.manufacturer}:{self.model or f'{self.product_code:04x}'}:{self.serial}"
+
+    def matches(self, spec: dict) -> bool:
+        """Return True if every field given in ``spec`` matches this monitor."""
+        manufacturer = spec.get("manufacturer")
+        if manufacturer and manufacturer.upper() != self.manufacturer:
+            return False
+        model = spec.get("model")
+        if model and model.lower() not in (self.model.lower(), f"{self.product_code:04x}"):
+            return False
+        serial = spec.get("serial")
+        if serial and serial != self.serial:
+            return False
+        return True
+
+
+def parse_monitor_spec(spec) -> dict:
+    """Accept ``"DEL:DELL U2720Q:ABC123"`` or a dict and return a match dict.
+
+    Trailing fields may be omitted to match any serial or model.
+    """
+    if isinstance(spec, dict):
+        return spec
+    fields = str(spec).split(":")
+    return dict(zip(("manufacturer", "model", "serial"), (f.strip() for f in fields)))
+
+
+def _descriptor_text(block: bytes) -> str:
+    return block[5:18].split(b"\n", 1)[0].decode("ascii", "replace").strip()
+
+
+def parse_edid(edid: bytes) -> dict:
+    """Extract manufacturer, product code, model name and serial from an EDID."""
+    if len(edid) < 128 or edid[:8] != b"\x00\xff\xff\xff\xff\xff\xff\x00":
+        raise ValueError("Not a valid EDID block")
+    packed = (edid[8] << 8) | edid[9]
+    manufacturer = "".join(chr(((packed >> shift) & 0x1F) + 64) for shift in (10, 5, 0))
+    product_code = edid[10] | (edid[11] << 8)
+    serial_number = int.from_bytes(edid[12:16], "little")
+    model = ""
+    serial = ""
+    for offset in (54, 72, 90, 108):
+        block = edid[offset:offset + 18]
+        if block[0:3] != b"\x00\x00\x00":
+            continue
+        if block[3] == 0xFC:
+            model = _descriptor_text(block)
+        elif block[3] == 0xFF:
+            serial = _descriptor_text(block)
+    return {
+        "manufacturer": manufacturer,
+        "product_code": product_code,
+        "model": model,
+        "serial": serial or (str(serial_number) if serial_number else ""),
+    }
+
+
+def connector_bus(connector_path: str):
+    """Return the i2c bus number used for DDC on a DRM connector, or None."""
+    ddc_link = os.path.join(connector_path, "ddc")
+    if os.path.exists(ddc_link):
+        name = os.path.basename(os.path.realpath(ddc_link))
+        if name.startswith("i2c-"):
+            return name[4:]
+    # Some drivers (e.g. DP AUX channels) expose the adapter as a child node.
+    for child in glob.glob(os.path.join(connector_path, "i2c-*")):
+        return os.path.basename(child)[4:]
+    return None
+
+
+def list_monitors(drm_class: str = DRM_CLASS) -> list:
+    """Return a MonitorInfo for every connected monitor with a DDC bus."""
+    monitors = []
+    for connector_path in sorted(glob.glob(os.path.join(drm_class, "card*-*"))):
+        try:
+            with open(os.path.join(connector_path, "edid"), "rb") as f:
+                edid = f.read()
+        except OSError:
+            continue
+        if not edid:
+            continue
+        bus = connector_bus(connector_path)
+        if bus is None:
+            continue
+        try:
+            fields = parse_edid(edid)
+        except ValueError:
+            continue
+        monitors.append(MonitorInfo(
+            os.path.basename(connector_path), bus,
+            fields["manufacturer"], fields["product_code"], fields["model"], fields["serial"],
+            hashlib.sha1(edid).hexdigest(),
+        ))
+    return monitors
+
+
+def find_monitor(spec, drm_class: str = DRM_CLASS):
+    """Return the first connected monitor matching ``spec``, or None."""
+    match = parse_monitor_spec(spec)
+    for info in list_monitors(drm_class):
+        if info.matches(match):
+            return info
+    return None
+
+
+def monitor_on_bus(bus, drm_class: str = DRM_CLASS):
+    """Return the connected monitor on i2c bus ``bus``, or None."""
+    for info in list_monitors(drm_class):
+        if info.bus == str(bus):
+            return info
+    return None
+
+
+def parse_capabilities(caps: str) -> dict:
+    """Parse the ``vcp(...)`` section of a DDC/CI capabilities string.
+
+    Returns a dict mapping VCP feature codes to their allowed values (an
+    empty list for continuous features).
+    """
+    start = caps.lower().find("vcp(")
+    if start < 0:
+        return {}
+    tokens = re.findall(r"[0-9A-Fa-f]{2}|\(|\)", caps[start + 4:])
+    features = {}
+    depth = 0
+    current = None
+    for token in tokens:
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            if depth == 0:
+                break
+            depth -= 1
+        elif depth == 0:
+            current = int(token, 16)
+            features[current] = []
+        elif depth == 1 and current is not None:
+            features[current].append(int(token, 16))
+    return features
+
+
+class CapabilitiesCache:
+    """JSON cache of per-monitor capabilities keyed by EDID hash."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = None
+        # Bus workers update entries concurrently.
+        self._lock = threading.RLock()
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def save(self) -> None:
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._load(), f, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def get(self, info: MonitorInfo):
+        return self._load().get(info.edid_hash)
+
+    def _entry(self, info: MonitorInfo) -> dict:
+        return self._load().setdefault(info.edid_hash, {
+            "monitor": info.key,
+            "quirks": {},
+        })
+
+    def update(self, info: MonitorInfo, **fields) -> dict:
+        with self._lock:
+            entry = self._entry(info)
+            entry.update(fields)
+            self.save()
+        return entry
+
+    def set_quirk(self, info: MonitorInfo, name: str, value) -> None:
+        """Persist one learned timing value for the monitor."""
+        with self._lock:
+            self._entry(info).setdefault("quirks", {})[name] = value
+            self.save()
+
+    def ensure(self, info: MonitorInfo, backend) -> dict:
+        """Return cached capabilities, probing the monitor only on a miss.
+
+        An entry holding only learned quirks counts as a miss.
+        """
+        entry = self.get(info)
+        if entry is not None and "input_codes" in entry:
+            return entry
+        try:
+            features = parse_capabilities(backend.get_capabilities())
+        except Exception as e:
+            logger.warning(f"Could not read capabilities of {info.key}: {e}")
+            return {"monitor": info.key, "input_codes": [], "quirks": {}}
+        logger.info(f"Cached capabilities for {info.key}")
+        return self.update(info, input_codes=features.get(0x60, []))
@@ -0,0 +1,252 @@
+"""Recent switch outcomes kept in memory, with running statistics.
+
+Every monitor result is recorded as a small ``SwitchEvent`` in a fixed-size
+ring buffer, and per-day and since-start totals are updated as events come
+in, so "how often did we flip today, how long did it take and what failed"
+is answered without reading the log. The buffer can be saved on shutdown
+as a compact binary snapshot and loaded on the next start; restored events
+are listed again but not counted in the totals.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger("usb_monitor")
+
+OUTCOMES = ("switched", "skipped", "failed", "superseded")
+
+SNAPSHOT_MAGIC = b"UMSH"
+SNAPSHOT_VERSION = 2
+# magic, version, event count, string table length
+SNAPSHOT_HEADER = struct.Struct("<4sHII")
+# time, duration, outcome, then string table indexes of trigger, monitor, input and error
+SNAPSHOT_EVENT = struct.Struct("<ddBIIII")
+NO_STRING = 0xFFFFFFFF
+
+
+def outcome_of(result) -> str:
+    if result.superseded:
+        return "superseded"
+    if not result.ok:
+        return "failed"
+    return "skipped" if result.skipped else "switched"
+
+
+class SwitchEvent:
+    """One monitor's part of a switch."""
+
+    __slots__ = ("time", "trigger", "monitor", "input_code", "duration", "outcome", "error")
+
+    def __init__(self, time, trigger, monitor, input_code, duration, outcome, error=None):
+        self.time = time
+        self.trigger = trigger
+        self.monitor = monitor
+        self.input_code = input_code
+        self.duration = duration
+        self.outcome = outcome
+        self.error = error
+
+    def as_dict(self) -> dict:
+        return {
+            "time": round(self.time, 3),
+            "trigger": self.trigger,
+            "monitor": self.monitor,
+            "input": self.input_code,
+            "ms": round(self.duration * 1000, 1),
+            "outcome": self.outcome,
+            "error": self.error,
+        }
+
+
+class SwitchStats:
+    """Running totals over a stream of events."""
+
+    __slots__ = ("outcomes", "triggers", "switch_time", "switch_max")
+
+    def __init__(self):
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.triggers = {}
+        # Durations of actual input changes only; skips cost a read at most.
+        self.switch_time = 0.0
+        self.switch_max = 0.0
+
+    def add(self, event: SwitchEvent) -> None:
+        self.outcomes[event.outcome] += 1
+        self.triggers[event.trigger] = self.triggers.get(event.trigger, 0) + 1
+        if event.outcome == "switched":
+            self.switch_time += event.duration
+            self.switch_max = max(self.switch_max, event.duration)
+
+    def as_dict(self) -> dict:
+        switched = self.outcomes["switched"]
+        return {
+            "events": sum(self.outcomes.values()),
+            **self.outcomes,
+            "mean_ms": round(self.switch_time / switched * 1000, 1) if switched else None,
+            "max_ms": round(self.switch_max * 1000, 1) if switched else None,
+            "triggers": dict(self.triggers),
+        }
+
+
+def day_of(timestamp: float) -> tuple:
+    return time.localtime(timestamp)[:3]
+
+
+class History:
+    """Ring buffer of the last ``size`` events plus today's and overall totals.
+
+    Events are recorded on the event loop and read from the tray thread, so
+    access goes through a lock.
+    """
+
+    def __init__(self, size: int = 500, path: str = None):
+        self.path = path
+        self._events = [None] * size
+        self._next = 0
+        self._count = 0
+        self._day = None
+        self.total = SwitchStats()
+        self.today = SwitchStats()
+        self.last_failure = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _store(self, event: SwitchEvent) -> None:
+        self._events[self._next] = event
+        self._next = (self._next + 1) % len(self._events)
+        self._count = min(self._count + 1, len(self._events))
+        if event.outcome == "failed":
+            self.last_failure = event
+
+    def _add(self, event: SwitchEvent) -> None:
+        self._store(event)
+        day = day_of(event.time)
+        if day != self._day:
+            self._day = day
+            self.today = SwitchStats()
+        self.total.add(event)
+        self.today.add(event)
+
+    def record(self, batch, trigger: str) -> None:
+        """Add one event per monitor result in a finished ``SwitchBatch``."""
+        now = time.time()
+        with self._lock:
+            for result in batch.results:
+                self._add(SwitchEvent(
+                    now, trigger, result.name, result.input_code, result.duration, outcome_of(result),
+                    str(result.error) if result.error else None,
+                ))
+
+    def events(self, limit: int = None) -> list:
+        """Return the stored events, oldest first, or only the newest ``limit``."""
+        with self._lock:
+            size = len(self._events)
+            start = (self._next - self._count) % size
+            events = [self._events[(start + i) % size] for i in range(self._count)]
+        return events[-limit:] if limit else events
+
+    def resize(self, size: int) -> None:
+        """Change the capacity, keeping the newest events."""
+        if size == len(self._events):
+            return
+        events = self.events()[-size:]
+        with self._lock:
+            self._events = events + [None] * (size - len(events))
+            self._count = len(events)
+            self._next = self._count % size
+
+    def stats(self) -> dict:
+        with self._lock:
+            today = self.today if self._day == day_of(time.time()) else SwitchStats()
+            return {
+                "today": today.as_dict(),
+                "total": self.total.as_dict(),
+                "stored": self._count,
+                "capacity": len(self._events),
+                "last_failure": self.last_failure.as_dict() if self.last_failure else None,
+            }
+
+    def summary(self, recent: int = 10) -> str:
+        """Return a few lines of plain text for the tray."""
+        stats = self.stats()
+        lines = []
+        for label, totals in (("Today", stats["today"]), ("Since start", stats["total"])):
+            timing = f", mean {totals['mean_ms']:.0f} ms, max {totals['max_ms']:.0f} ms" if totals["switched"] else ""
+            lines.append(f"{label}: {totals['switched']} switched, {totals['skipped']} skipped, "
+                         f"{totals['failed']} failed{timing}")
+        failure = stats["last_failure"]
+        if failure:
+            lines.append(f"Last failure: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(failure['time']))} "
+                         f"{failure['monitor']} -> {failure['input']}: {failure['error']}")
+        events = self.events(recent)
+        if events:
+            lines.append("")
+            lines.append("Recent:")
+            for event in reversed(events):
+                lines.append(f"{time.strftime('%H:%M:%S', time.localtime(event.time))} {event.monitor} -> "
+                             f"{event.input_code} {event.outcome} in {event.duration * 1000:.0f} ms ({event.trigger})")
+        return "\n".join(lines)
+
+    def save(self) -> None:
+        """Write the stored events to ``path`` as a binary snapshot."""
+        if not self.path:
+            return
+        events = self.events()
+        strings = {}
+
+        def index(text):
+            if text is None:
+                return NO_STRING
+            return strings.setdefault(text, len(strings))
+
+        packed = b"".join(
+            SNAPSHOT_EVENT.pack(event.time, event.duration, OUTCOMES.index(event.outcome), index(event.trigger),
+                                index(event.monitor), index(event.input_code), index(event.error))
+            for event in events
+        )
+        table = json.dumps(list(strings), separators=(",", ":")).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(events), len(table)))
+                f.write(table)
+                f.write(packed)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save switch history to {self.path}: {e}")
+
+    def load(self) -> None:
+        """Restore events saved by ``save()``; a missing or damaged file is ignored."""
+        if not self.path:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            magic, version, count, table_length = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError("not a switch history snapshot")
+            offset = SNAPSHOT_HEADER.size
+            strings = json.loads(data[offset:offset + table_length].decode("utf-8"))
+            offset += table_length
+            events = []
+            for when, duration, outcome, *indexes in SNAPSHOT_EVENT.iter_unpack(
+                    data[offset:offset + count * SNAPSHOT_EVENT.size]):
+                trigger, monitor, input_code, error = (
+                    None if i == NO_STRING else strings[i] for i in indexes
+                )
+                events.append(SwitchEvent(when, trigger, monitor, input_code, duration, OUTCOMES[outcome], error))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            logger.warning(f"Ignoring switch history snapshot {self.path}: {e}")
+            return
+        with self._lock:
+            for event in events[-len(self._events):]:
+                self._store(event)
+        logger.info(f"Restored {len(events)} switch history event(s)")
@@ -0,0 +1,96 @@
+"""USB hotplug detection engines.
+
+The udev engine exposes a netlink monitor socket for the event loop to watch,
+so the daemon only wakes up when the kernel reports a device change. The
+polling engine keeps the old fixed interval behaviour for systems where
+netlink is not available.
+"""
+import logging
+
+import pyudev
+
+logger = logging.getLogger("usb_monitor")
+
+USB_ACTIONS = ("add", "remove", "bind", "unbind")
+# DRM connector uevents fire on monitor hotplug and power state changes.
+DRM_ACTIONS = ("add", "remove", "change")
+
+DEFAULT_POLL_INTERVAL = 2.0
+# A dock flip can queue hundreds of uevents at once; the default socket
+# buffer overflows (ENOBUFS) and drops them.
+RECEIVE_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class UdevDetector:
+    """Wait for USB device and DRM connector uevents on a netlink monitor."""
+
+    mode = "udev"
+
+    def __init__(self, context: pyudev.Context):
+        self.monitor = pyudev.Monitor.from_netlink(context)
+        # filter_by() installs a socket filter, so unrelated uevents are
+        # dropped in the kernel and never wake this process up.
+        self.monitor.filter_by(subsystem="usb", device_type="usb_device")
+        self.monitor.filter_by(subsystem="drm")
+        try:
+            self.monitor.set_receive_buffer_size(RECEIVE_BUFFER_SIZE)
+        except OSError as e:
+            logger.debug(f"Could not enlarge the uevent receive buffer: {e}")
+
+    def start(self) -> None:
+        self.monitor.start()
+
+    def fileno(self) -> int:
+        return self.monitor.fileno()
+
+    @staticmethod
+    def is_relevant(device) -> bool:
+        if device.subsystem == "drm":
+            return device.action in DRM_ACTIONS
+        return device.action in USB_ACTIONS
+
+    def read_pending(self) -> list:
+        """Return every relevant uevent already queued, without blocking.
+
+        Meant to be called when an event loop reports the socket readable.
+        Raises ``OSError`` if the socket overflowed and uevents were lost.
+        """
+        devices = []
+        while True:
+            device = self.monitor.poll(timeout=0)
+            if device is None:
+                return devices
+            if self.is_relevant(device):
+                devices.append(device)
+
+
+class PollingDetector:
+    """Fallback detector: the event loop re-enumerates every ``interval`` seconds."""
+
+    mode = "poll"
+
+    def __init__(self, interval: float = DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+
+    def start(self) -> None:
+        pass
+
+    def fileno(self):
+        return None
+
+    def read_pending(self) -> list:
+        return []
+
+
+def create_detector(context: pyudev.Context, mode: str = "udev", poll_interval: float = DEFAULT_POLL_INTERVAL):
+    """Return a detector for ``mode``, falling back to polling if udev fails."""
+    if mode == "udev":
+        try:
+            detector = UdevDetector(context)
+            detector.start()
+            return detector
+        except Exception as e:
+            logger.warning(f"udev monitor unavailable, falling back to polling: {e}")
+    detector = PollingDetector(poll_interval)
+    detector.start()
+    return detector
@@ -0,0 +1,48 @@
+"""Lookup of the tray icons pre-rendered by ``crop_image.py``.
+
+``icons/icons.json`` maps icon name, theme, tray state and pixel size to a
+file, so the tray loads an image of the right size as is. Without the
+manifest the caller falls back to the full-size artwork.
+"""
+import json
+import logging
+import os
+
+logger = logging.getLogger("usb_monitor")
+
+MANIFEST = "icons.json"
+MANIFEST_VERSION = 1
+DEFAULT_THEME = "default"
+
+
+def load_manifest(directory: str):
+    """Return the parsed manifest in ``directory``, or None if there is none."""
+    try:
+        with open(os.path.join(directory, MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except OSError:
+        return None
+    except ValueError as e:
+        logger.warning(f"Ignoring invalid icon manifest in {directory}: {e}")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Ignoring icon manifest version {manifest.get('version')} in {directory}")
+        return None
+    return manifest
+
+
+def icon_path(manifest, directory: str, theme: str, state: str, size: int, name: str = "monitor"):
+    """Return the file for ``theme`` and ``state`` closest to ``size`` px, or None.
+
+    The smallest icon at least ``size`` wide is preferred; a missing theme
+    falls back to the default artwork.
+    """
+    if not manifest:
+        return None
+    themes = manifest.get("icons", {}).get(name, {})
+    sizes = themes.get(theme, {}).get(state) or themes.get(DEFAULT_THEME, {}).get(state)
+    if not sizes:
+        return None
+    available = sorted(int(px) for px in sizes)
+    chosen = next((px for px in available if px >= size), available[-1])
+    return os.path.join(directory, sizes[str(chosen)])
@@ -0,0 +1,78 @@
+"""Logging pipeline that keeps file I/O off the switching hot path.
+
+The ``usb_monitor`` logger only has a ``QueueHandler``; a ``QueueListener``
+thread owns the ``RotatingFileHandler`` and does the formatting, writing and
+rotation. Log calls on the event loop or a bus worker therefore only append
+to an in-memory queue.
+
+With ``log_format`` set to ``json`` each line is a JSON object. Structured
+fields are passed through ``extra``:
+
+    logger.info("...", extra={"event": "switch", "monitor": "left",
+                              "input": "15", "duration_ms": 48.2})
+"""
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+FIELDS = ("event", "device", "monitor", "input", "duration_ms")
+TEXT_FORMAT = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S")
+
+_listener = None
+_file_handler = None
+_queue_handler = None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format a record as one JSON object per line."""
+
+    def format(self, record) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def formatter_for(log_format: str) -> logging.Formatter:
+    return JsonLinesFormatter() if log_format == "json" else TEXT_FORMAT
+
+
+def start(path: str, log_format: str = "text") -> logging.Logger:
+    """Route the ``usb_monitor`` logger through a queue to a rotating file."""
+    global _listener, _file_handler, _queue_handler
+    logger = logging.getLogger("usb_monitor")
+    if _listener is not None:
+        return logger
+    _file_handler = RotatingFileHandler(path, maxBytes=1024 * 1024, backupCount=3, encoding="utf-8")
+    _file_handler.setFormatter(formatter_for(log_format))
+    records = queue.SimpleQueue()
+    _listener = QueueListener(records, _file_handler, respect_handler_level=True)
+    _listener.start()
+    logger.setLevel(logging.INFO)
+    _queue_handler = QueueHandler(records)
+    logger.addHandler(_queue_handler)
+    return logger
+
+
+def set_format(log_format: str) -> None:
+    """Switch between ``text`` and ``json`` lines without restarting the listener."""
+    if _file_handler is not None:
+        _file_handler.setFormatter(formatter_for(log_format))
+
+
+def stop() -> None:
+    """Flush queued records to disk and stop the writer thread."""
+    global _listener, _file_handler, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger("usb_monitor").removeHandler(_queue_handler)
+    _listener.stop()
+    _file_handler.close()
+    _listener = _file_handler = _queue_handler = None
@@ -0,0 +1,148 @@
+"""Latency histograms and counters for the switching hot path.
+
+Stages are timed with ``observe()`` (or the ``span()`` context manager) and
+kept as fixed-bucket histograms for Prometheus plus a bounded sample window
+for percentiles. Everything lives in a module-level registry so any module
+can record without passing objects around.
+
+Stages:
+    uevent     reading queued uevents off the netlink socket
+    presence   presence index and rule evaluation for one uevent
+    queue      time a DDC command waited for its bus worker
+    ddc_read   reading VCP 0x60 before a write
+    ddc_write  the Set VCP write itself
+    verify     reading the input back until the monitor reports it, with rewrites
+    profile    reading and writing a display profile's other VCP features
+    flip       first uevent of a change until every monitor was switched
+"""
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SAMPLE_WINDOW = 2048
+
+COUNTERS = {
+    "uevents_total": "USB and DRM uevents handled",
+    "switches_total": "VCP 0x60 writes sent to a monitor",
+    "switch_failures_total": "Monitor switches that failed",
+    "switch_retries_total": "Extra write attempts after a switch did not verify",
+    "switch_skipped_total": "Switches suppressed because the monitor already had the input",
+    "switch_superseded_total": "Queued switches dropped in favour of a newer command",
+}
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "samples")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.samples.append(seconds)
+
+    def percentile(self, fraction: float) -> float:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Registry:
+    """Thread-safe collection of stage histograms and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.gauges = {}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms = {}
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.gauges = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def percentiles(self) -> dict:
+        """Return ``{stage: {count, p50, p90, p99, max}}`` in milliseconds."""
+        with self._lock:
+            report = {}
+            for stage, histogram in sorted(self.histograms.items()):
+                report[stage] = {
+                    "count": histogram.count,
+                    "p50": round(histogram.percentile(0.50) * 1000, 3),
+                    "p90": round(histogram.percentile(0.90) * 1000, 3),
+                    "p99": round(histogram.percentile(0.99) * 1000, 3),
+                    "max": round(max(histogram.samples, default=0.0) * 1000, 3),
+                }
+            return report
+
+    def prometheus(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines.append("# HELP usb_monitor_stage_seconds Latency of each switching stage")
+            lines.append("# TYPE usb_monitor_stage_seconds histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'usb_monitor_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'usb_monitor_stage_seconds_sum{{stage="{stage}"}} {histogram.total}')
+                lines.append(f'usb_monitor_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# HELP usb_monitor_{name} {COUNTERS.get(name, name)}")
+                lines.append(f"# TYPE usb_monitor_{name} counter")
+                lines.append(f"usb_monitor_{name} {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE usb_monitor_{name} gauge")
+                lines.append(f"usb_monitor_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """Atomically write the metrics for node_exporter's textfile collector."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+registry = Registry()
+observe = registry.observe
+inc = registry.inc
+set_gauge = registry.set_gauge
+
+
+@contextmanager
+def span(stage: str):
+    """Time the enclosed block as ``stage``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(stage, time.perf_counter() - start)
@@ -0,0 +1,122 @@
+"""In-memory index of the USB devices currently present.
+
+The index is seeded from one enumeration and then kept up to date from
+hotplug deltas, so presence checks are a set lookup instead of a walk over
+every device on the bus.
+"""
+import logging
+
+logger = logging.getLogger("usb_monitor")
+
+REMOVE_ACTIONS = ("remove",)
+
+
+def device_keys(device) -> tuple:
+    """Return the lookup keys for a udev device.
+
+    Every device gets ``vid:pid`` and ``vid:*`` keys, plus ``vid:pid:serial``
+    and ``serial:<serial>`` when udev knows its serial number. Devices
+    without IDs return no keys.
+    """
+    vid = device.get("ID_VENDOR_ID", "").lower()
+    pid = device.get("ID_MODEL_ID", "").lower()
+    if not vid or not pid:
+        return ()
+    key = f"{vid}:{pid}"
+    serial = device.get("ID_SERIAL_SHORT", "").lower()
+    if serial:
+        return (key, f"{vid}:*", f"{key}:{serial}", f"serial:{serial}")
+    return (key, f"{vid}:*")
+
+
+class PresenceIndex:
+    """Reference-counted set of VID:PID (and serial) keys for present devices."""
+
+    def __init__(self):
+        self._by_path = {}
+        self._counts = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._counts
+
+    def __len__(self) -> int:
+        return len(self._by_path)
+
+    def keys(self) -> set:
+        return set(self._counts)
+
+    def has_path(self, sys_path: str) -> bool:
+        return sys_path in self._by_path
+
+    def items(self):
+        """Return ``(sys_path, keys)`` for every present device."""
+        return self._by_path.items()
+
+    def _add(self, sys_path: str, keys: tuple) -> tuple:
+        added = []
+        self._by_path[sys_path] = keys
+        for key in keys:
+            count = self._counts.get(key, 0)
+            if count == 0:
+                added.append(key)
+            self._counts[key] = count + 1
+        return tuple(added)
+
+    def _remove(self, sys_path: str) -> tuple:
+        removed = []
+        for key in self._by_path.pop(sys_path, ()):
+            count = self._counts[key] - 1
+            if count:
+                self._counts[key] = count
+            else:
+                del self._counts[key]
+                removed.append(key)
+        return tuple(removed)
+
+    def add(self, sys_path: str, keys: tuple) -> tuple:
+        """Mark ``keys`` present under ``sys_path`` ahead of its uevent; return the new keys."""
+        if sys_path in self._by_path:
+            return ()
+        return self._add(sys_path, keys)
+
+    def discard(self, sys_path: str) -> tuple:
+        """Forget ``sys_path`` and return the keys that are no longer present."""
+        return self._remove(sys_path)
+
+    def seed(self, devices) -> None:
+        """Rebuild the index from a full device enumeration."""
+        self._by_path.clear()
+        self._counts.clear()
+        for device in devices:
+            keys = device_keys(device)
+            if keys:
+                self._add(device.sys_path, keys)
+
+    def apply(self, device) -> tuple:
+        """Apply one uevent and return ``(added_keys, removed_keys)``.
+
+        Removals are resolved by sysfs path, because udev may no longer have
+        the IDs of a device that has already gone away.
+        """
+        removed = self._remove(device.sys_path)
+        if device.action in REMOVE_ACTIONS:
+            return (), removed
+        keys = device_keys(device)
+        added = self._add(device.sys_path, keys) if keys else ()
+        # A re-announced device (bind/change) shows up in both lists; only
+        # report keys whose presence actually changed.
+        common = set(added) & set(removed)
+        if common:
+            added = tuple(k for k in added if k not in common)
+            removed = tuple(k for k in removed if k not in common)
+        return added, removed
+
+    def reconcile(self, devices, warn: bool = True) -> bool:
+        """Re-seed from a fresh enumeration and return True if anything drifted."""
+        before = dict(self._counts)
+        self.seed(devices)
+        if before != self._counts:
+            if warn:
+                logger.warning("Presence index was stale and has been reconciled")
+            return True
+        return False
@@ -0,0 +1,55 @@
+"""Startup readiness checks that replace fixed boot-time sleeps.
+
+At boot the daemon may start before udev has finished processing the
+coldplug queue or before ``/dev/i2c-N`` exists with the right permissions.
+Instead of sleeping for a fixed time, these helpers check the actual
+conditions and return as soon as they hold.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger("usb_monitor")
+
+UDEV_CONTROL = "/run/udev/control"
+# systemd-udevd creates this file while it has uevents queued.
+UDEV_QUEUE = "/run/udev/queue"
+
+CHECK_INTERVAL = 0.05
+
+
+def wait_for(predicate, timeout: float, interval: float = CHECK_INTERVAL) -> bool:
+    """Call ``predicate`` until it returns True or ``timeout`` seconds pass."""
+    deadline = time.monotonic() + timeout
+    while True:
+        if predicate():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+
+def udev_ready() -> bool:
+    """True once udevd is running and has no queued events."""
+    return os.path.exists(UDEV_CONTROL) and not os.path.exists(UDEV_QUEUE)
+
+
+def i2c_ready(bus) -> bool:
+    """True once ``/dev/i2c-<bus>`` exists and is readable and writable."""
+    return os.access(f"/dev/i2c-{bus}", os.R_OK | os.W_OK)
+
+
+def wait_until_ready(buses=(), timeout: float = 30.0) -> bool:
+    """Wait for udev and every i2c bus in ``buses``; return False on timeout."""
+    start = time.monotonic()
+    ready = True
+    if not wait_for(udev_ready, timeout):
+        logger.warning("udev did not settle in time, continuing anyway")
+        ready = False
+    for bus in buses:
+        remaining = max(0.0, timeout - (time.monotonic() - start))
+        if not wait_for(lambda: i2c_ready(bus), remaining):
+            logger.warning(f"/dev/i2c-{bus} not accessible in time, continuing anyway")
+            ready = False
+    logger.info(f"Startup readiness checks took {(time.monotonic() - start) * 1000:.0f} ms")
+    return ready
@@ -0,0 +1,158 @@
+"""Rules that map present USB devices to monitor inputs.
+
+Rules from ``settings.json`` are compiled into a dict from presence key to
+the rules it satisfies. Hotplug deltas only touch the rules indexed under the
+changed keys, so evaluation cost does not grow with the number of rules or
+devices.
+
+A rule looks like::
+
+    {"name": "mac", "match": ["05ac:*", "serial:C02XYZ"], "inputs": {"left": "17"}, "priority": 10}
+
+``match`` entries are ``vid:pid``, ``vid:pid:serial``, ``vid:*`` (or a bare
+``vid``) and ``serial:<serial>``. ``inputs`` is ``"connected"``,
+``"disconnected"``, a single input code for every monitor, or a dict of
+monitor name to input code. The highest priority matching rule wins; ties go
+to the rule listed first.
+"""
+import logging
+
+logger = logging.getLogger("usb_monitor")
+
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+
+
+def normalize_pattern(pattern: str) -> str:
+    """Return the presence key a match pattern corresponds to."""
+    text = str(pattern).strip().lower()
+    if text.startswith("serial:"):
+        return text
+    if ":" not in text:
+        return f"{text}:*"
+    return text
+
+
+class Rule:
+    __slots__ = ("name", "priority", "order", "inputs", "patterns", "profile")
+
+    def __init__(self, name, priority, order, inputs, patterns, profile=None):
+        self.name = name
+        self.priority = priority
+        self.order = order
+        self.inputs = inputs
+        self.patterns = patterns
+        self.profile = profile
+
+    def outranks(self, other) -> bool:
+        if other is None:
+            return True
+        return (self.priority, -self.order) > (other.priority, -other.order)
+
+
+def compile_rules(config: dict) -> list:
+    """Build Rule objects from ``rules`` or the legacy ``keyboard_id`` setting."""
+    entries = config.get("rules")
+    if not entries:
+        entries = [{
+            "name": "keyboard",
+            "match": [config.get("keyboard_id", "046d:c31c")],
+            "inputs": CONNECTED,
+            "profile": config.get("profile_connected"),
+        }]
+    compiled = []
+    for order, entry in enumerate(entries):
+        patterns = entry.get("match", [])
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        compiled.append(Rule(
+            entry.get("name", f"rule{order + 1}"),
+            int(entry.get("priority", 0)),
+            order,
+            entry.get("inputs", CONNECTED),
+            tuple(normalize_pattern(p) for p in patterns),
+            entry.get("profile") or None,
+        ))
+    return compiled
+
+
+def resolve_targets(inputs, displays: dict) -> dict:
+    """Turn a rule's ``inputs`` into ``{display name: input code}``."""
+    if isinstance(inputs, dict):
+        return {name: code for name, code in inputs.items() if name in displays}
+    if inputs == CONNECTED:
+        return {name: display.input_for(True) for name, display in displays.items()}
+    if inputs == DISCONNECTED:
+        return {name: display.input_for(False) for name, display in displays.items()}
+    return {name: str(inputs) for name in displays}
+
+
+def resolve_profiles(profile, profiles: dict, targets: dict, displays: dict) -> dict:
+    """Return ``{display name: {vcp code: value}}`` for the displays in ``targets``.
+
+    A monitor's own ``profiles`` entry overrides the shared values.
+    """
+    if not profile:
+        return {}
+    shared = profiles.get(profile, {})
+    resolved = {}
+    for name in targets:
+        values = dict(shared)
+        values.update(displays[name].profiles.get(profile, {}))
+        if values:
+            resolved[name] = values
+    return resolved
+
+
+class RuleSet:
+    """Incrementally evaluated set of compiled rules."""
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._index = {}
+        for rule in self.rules:
+            for pattern in rule.patterns:
+                self._index.setdefault(pattern, []).append(rule)
+        self._counts = {}
+        self._winner = None
+
+    def watches(self, keys) -> bool:
+        """True if any rule matches one of ``keys``."""
+        return any(key in self._index for key in keys)
+
+    @property
+    def active(self):
+        """The highest priority rule with at least one matching device, or None."""
+        return self._winner
+
+    def seed(self, keys) -> None:
+        """Recompute match counts from the full set of present keys."""
+        self._counts.clear()
+        self._winner = None
+        self.apply(keys, ())
+
+    def apply(self, added, removed) -> bool:
+        """Update counts from a presence delta; return True if the winner changed."""
+        previous = self._winner
+        lost_winner = False
+        for key in removed:
+            for rule in self._index.get(key, ()):
+                count = self._counts[rule] - 1
+                if count:
+                    self._counts[rule] = count
+                else:
+                    del self._counts[rule]
+                    if rule is self._winner:
+                        lost_winner = True
+        for key in added:
+            for rule in self._index.get(key, ()):
+                self._counts[rule] = self._counts.get(rule, 0) + 1
+                if not lost_winner and rule.outranks(self._winner):
+                    self._winner = rule
+        if lost_winner:
+            # Only rules that currently match are candidates.
+            self._winner = None
+            for rule in self._counts:
+                if rule.outranks(self._winner):
+                    self._winner = rule
+        return self._winner is not previous
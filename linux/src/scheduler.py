@@ -0,0 +1,84 @@
+"""Debounce stage between hotplug detection and monitor switching.
+
+A USB switch flip produces a burst of remove/add uevents for the hub and
+every device behind it, and cheap switches sometimes bounce. The scheduler
+collects target changes, waits for them to settle and only commits the final
+target. If the target returns to what is already committed before the
+window closes, the pending switch is dropped.
+"""
+import logging
+import time
+
+logger = logging.getLogger("usb_monitor")
+
+UNSET = object()
+
+
+class SwitchScheduler:
+    """Coalesce target changes and commit them once they are stable.
+
+    ``settle`` is how long a target must stay unchanged before it is
+    committed. ``hold`` is the minimum time between two commits, which acts
+    as hysteresis against a switch that bounces back and forth.
+    """
+
+    def __init__(self, settle: float = 0.3, hold: float = 1.0, clock=time.monotonic):
+        self.settle = settle
+        self.hold = hold
+        self.clock = clock
+        self.committed = UNSET
+        self.pending = UNSET
+        self.deadline = None
+        self.last_commit = float("-inf")
+        self.proposed = 0
+        self.coalesced = 0
+        self.flaps_suppressed = 0
+        self.commits = 0
+
+    def propose(self, target) -> None:
+        """Record a new desired target; the latest proposal always wins."""
+        now = self.clock()
+        self.proposed += 1
+        if self.pending is not UNSET:
+            self.coalesced += 1
+        if self.committed is UNSET:
+            # Nothing committed yet, so there is nothing to flap against.
+            self.pending = target
+            self.deadline = now
+            return
+        if target is self.committed:
+            if self.pending is not UNSET:
+                self.flaps_suppressed += 1
+                logger.info("Input change reverted within settle window, switch cancelled")
+            self.pending = UNSET
+            self.deadline = None
+            return
+        self.pending = target
+        self.deadline = max(now + self.settle, self.last_commit + self.hold)
+
+    def timeout(self):
+        """Seconds until the pending target is due, or None if nothing is pending."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - self.clock())
+
+    def is_due(self) -> bool:
+        return self.deadline is not None and self.clock() >= self.deadline
+
+    def commit(self):
+        """Mark the pending target as committed and return it."""
+        target = self.pending
+        self.committed = target
+        self.pending = UNSET
+        self.deadline = None
+        self.last_commit = self.clock()
+        self.commits += 1
+        return target
+
+    def stats(self) -> dict:
+        return {
+            "proposed": self.proposed,
+            "coalesced": self.coalesced,
+            "flaps_suppressed": self.flaps_suppressed,
+            "commits": self.commits,
+        }
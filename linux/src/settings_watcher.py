@@ -0,0 +1,107 @@
+"""Reload settings.json when it changes, using inotify.
+
+The watch is on the settings directory, so both in-place saves and editors
+that write a temporary file and rename it over settings.json are seen. The
+inotify descriptor is registered with the daemon's event loop; parsing and
+validation run on the executor and only the finished ``Config`` is handed to
+``apply`` on the loop. A file that fails validation is logged and ignored.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+import config
+
+logger = logging.getLogger("usb_monitor")
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT_HEADER = struct.Struct("iIII")
+
+# Editors often write a file more than once per save.
+DEBOUNCE = 0.2
+
+
+def inotify_watch(directory: str, mask: int) -> int:
+    """Return a non-blocking inotify fd watching ``directory``."""
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, f"inotify_add_watch failed for {directory}")
+    return fd
+
+
+def event_names(data: bytes):
+    """Yield the file name of every event in an inotify read buffer."""
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        yield data[offset:offset + length].rstrip(b"\0").decode("utf-8", "replace")
+        offset += length
+
+
+class SettingsWatcher:
+    """core.Daemon service that applies a new ``Config`` after each save."""
+
+    def __init__(self, path: str, apply):
+        self.path = path
+        self.apply = apply
+        self.loop = None
+        self._fd = None
+        self._timer = None
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        try:
+            self._fd = inotify_watch(os.path.dirname(self.path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"Cannot watch {self.path} for changes, use 'reload' instead: {e}")
+            return
+        self.loop.add_reader(self._fd, self._on_readable)
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        if os.path.basename(self.path) in event_names(data):
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = self.loop.call_later(DEBOUNCE, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self.loop.create_task(self._reload_logged())
+
+    async def _reload_logged(self) -> None:
+        try:
+            await self.reload()
+        except config.ConfigError as e:
+            logger.error(f"Ignoring invalid settings, keeping the previous configuration: {e}")
+        except Exception as e:
+            logger.error(f"Reloading settings failed, keeping the previous configuration: {e}")
+
+    async def reload(self):
+        """Load and validate the settings off the loop, then apply them on it."""
+        new_config = await self.loop.run_in_executor(None, config.load, self.path)
+        self.apply(new_config)
+        return new_config
@@ -0,0 +1,82 @@
+"""Last-known daemon state, persisted so a restart can skip the startup switch.
+
+The snapshot holds the present device keys, the input each monitor was last
+confirmed on, the winning rule and the settings digest. It lives in
+``$XDG_RUNTIME_DIR`` when available (tmpfs, cleared at logout and reboot) and
+in the settings directory otherwise; the kernel boot ID guards the latter
+against being trusted after a reboot.
+"""
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("usb_monitor")
+
+VERSION = 1
+FILE_NAME = "usb_monitor.state.json"
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+
+def default_path(app_data: str) -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, FILE_NAME)
+    return os.path.join(app_data, FILE_NAME)
+
+
+def boot_id() -> str:
+    try:
+        with open(BOOT_ID, "r", encoding="ascii") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+class StateFile:
+    """Atomic JSON snapshot; identical snapshots are not rewritten."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._boot_id = boot_id()
+        self._last = None
+        # Saves are handed to the loop's executor and may overlap.
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Return the snapshot written during this boot, or None."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get("version") != VERSION:
+            return None
+        if snapshot.get("boot_id") != self._boot_id:
+            logger.info("Saved state is from an earlier boot, ignoring it")
+            return None
+        return snapshot
+
+    def save(self, config_digest: str, rule: str, inputs: dict, devices) -> None:
+        snapshot = {
+            "version": VERSION,
+            "boot_id": self._boot_id,
+            "config": config_digest,
+            "rule": rule,
+            "inputs": inputs,
+            "devices": sorted(devices),
+        }
+        data = json.dumps(snapshot, indent=1)
+        with self._lock:
+            if data == self._last:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning(f"Could not save state to {self.path}: {e}")
+                return
+            self._last = data
@@ -0,0 +1,571 @@
+"""Multi-monitor switching engine.
+
+Each configured display is resolved to its i2c bus, and every bus is owned
+by a single worker thread that runs its DDC commands from a priority queue.
+Writes to different monitors run concurrently, commands for the same bus
+never interleave, manual switches jump ahead of automatic ones, and a command
+that has been superseded by a newer one for the same monitor is dropped
+before it reaches the bus. Callers get futures and never wait on I2C.
+"""
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+
+import ddc
+import discovery
+import metrics
+
+logger = logging.getLogger("usb_monitor")
+
+
+class Display:
+    """One monitor from the settings file and its input codes."""
+
+    def __init__(self, name: str, bus: str, spec, input_connected: str, input_disconnected: str,
+                 profiles: dict = None):
+        self.name = name
+        self.bus = str(bus)
+        self.spec = spec
+        self.input_connected = input_connected
+        self.input_disconnected = input_disconnected
+        # Per-monitor overrides of the shared profiles, {profile: {code: value}}.
+        self.profiles = profiles or {}
+
+    def input_for(self, connected: bool) -> str:
+        return self.input_connected if connected else self.input_disconnected
+
+    def resolve(self):
+        """Return ``(bus, info)``, looking the monitor up by EDID if named."""
+        if self.spec:
+            info = discovery.find_monitor(self.spec)
+            if info is not None:
+                return info.bus, info
+            logger.warning(f"Monitor '{self.spec}' not found, using bus {self.bus}")
+        return self.bus, None
+
+
+def load_displays(config: dict) -> list:
+    """Build the display list from ``monitors`` or the legacy single-monitor keys."""
+    bus = config.get("monitor_bus", "1")
+    input_connected = config.get("input_connected", "15")
+    input_disconnected = config.get("input_disconnected", "18")
+    entries = config.get("monitors") or [{
+        "name": "monitor",
+        "bus": bus,
+        "monitor": config.get("monitor", ""),
+    }]
+    displays = []
+    for index, entry in enumerate(entries):
+        displays.append(Display(
+            entry.get("name", f"monitor{index + 1}"),
+            entry.get("bus", bus),
+            entry.get("monitor", ""),
+            entry.get("input_connected", input_connected),
+            entry.get("input_disconnected", input_disconnected),
+            entry.get("profiles"),
+        ))
+    return displays
+
+
+# Queue priorities, lowest runs first.
+CONTROL = 0
+MANUAL = 1
+AUTOMATIC = 2
+HOUSEKEEPING = 3
+
+# Write verification: the first read-back happens after the monitor's learned
+# settle time, later ones every VERIFY_POLL seconds. A monitor that still
+# reports the old input after REWRITE_FACTOR times its learned settle time
+# (half the verify window while nothing is learned yet) gets the write again.
+# One that stays silent for SILENT_SWITCHES switches in a row is no longer
+# verified.
+DEFAULT_SETTLE = 0.1
+MIN_SETTLE = 0.02
+VERIFY_POLL = 0.05
+REWRITE_FACTOR = 2.0
+SETTLE_SMOOTHING = 0.3
+SILENT_SWITCHES = 3
+
+
+class SwitchResult:
+    """Outcome of switching one display."""
+
+    __slots__ = ("name", "bus", "input_code", "ok", "skipped", "superseded", "error", "duration", "retries",
+                 "adjusted")
+
+    def __init__(self, name, bus, input_code, ok=True, skipped=False, superseded=False, error=None,
+                 duration=0.0, retries=0, adjusted=0):
+        self.name = name
+        self.bus = bus
+        self.retries = retries
+        self.adjusted = adjusted
+        self.input_code = input_code
+        self.ok = ok
+        self.skipped = skipped
+        self.superseded = superseded
+        self.error = error
+        self.duration = duration
+
+
+class BusWorker:
+    """Thread that owns one i2c bus and runs its commands by priority."""
+
+    def __init__(self, bus: str):
+        self.bus = bus
+        self._queue = queue.PriorityQueue()
+        self._thread = threading.Thread(target=self._run, name=f"ddc-bus-{bus}", daemon=True)
+        self._thread.start()
+
+    def submit(self, priority: int, seq: int, fn) -> Future:
+        future = Future()
+        self._queue.put((priority, seq, future, fn))
+        return future
+
+    def stop(self, cleanup=None) -> None:
+        """Exit once the queued commands ran, calling ``cleanup`` last."""
+        self._queue.put((float("inf"), 0, None, cleanup))
+
+    def _run(self) -> None:
+        while True:
+            _, _, future, fn = self._queue.get()
+            if future is None:
+                if fn is not None:
+                    try:
+                        fn()
+                    except Exception as e:
+                        logger.warning(f"Cleaning up bus {self.bus} failed: {e}")
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class SwitchBatch:
+    """Futures for one fan-out, with a callback once every display is done."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.total = None
+        self.results = []
+        self._futures = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._sealed = False
+
+    def _track(self, future: Future) -> None:
+        self._futures.append(future)
+        future.add_done_callback(self._future_done)
+
+    def _add_result(self, result: SwitchResult) -> None:
+        with self._lock:
+            self.results.append(result)
+
+    def _future_done(self, future: Future) -> None:
+        try:
+            result = future.result()
+        except BaseException as e:
+            result = SwitchResult(None, None, None, ok=False, error=e)
+        with self._lock:
+            self.results.append(result)
+        self._check_done()
+
+    def _seal(self) -> None:
+        self._sealed = True
+        self._check_done()
+
+    def _check_done(self) -> None:
+        with self._lock:
+            if not self._sealed or self._done.is_set():
+                return
+            if any(not future.done() for future in self._futures):
+                return
+            self.total = time.perf_counter() - self.start
+            self._done.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback) -> None:
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None) -> tuple:
+        """Block until done and return ``(results, total_seconds)``."""
+        self._done.wait(timeout)
+        return self.results, self.total
+
+
+class SwitchEngine:
+    """Switch several displays in parallel with one worker per i2c bus."""
+
+    def __init__(self, displays, backend_name: str, ddcutil_command: str,
+                 input_cache: ddc.InputStateCache, capabilities: discovery.CapabilitiesCache,
+                 backend_factory=ddc.create_backend, verify_timeout: float = 2.0, max_retries: int = 2):
+        self.displays = {display.name: display for display in displays}
+        self.backend_name = backend_name
+        self.ddcutil_command = ddcutil_command
+        self.backend_factory = backend_factory
+        self.input_cache = input_cache
+        self.capabilities = capabilities
+        self.verify_timeout = verify_timeout
+        self.max_retries = max_retries
+        self._backends = {}
+        self._unprobed = {}
+        self._info = {}
+        # Learned seconds from a write until the monitor reports the new input.
+        self._settle = {}
+        self._saved_settle = {}
+        # Displays that never answer a read-back right after switching, and
+        # how many switches in a row each display has stayed silent.
+        self._unverifiable = set()
+        self._silent = {}
+        self._workers = {}
+        # Buses whose worker was told to stop and close their backends.
+        self._stopping = set()
+        self._latest = {}
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def backend_for(self, display: Display):
+        """Return the DDC backend for ``display``, creating it on first use.
+
+        Only sysfs and the capabilities cache are read here; a capabilities
+        probe, if needed, runs later on the bus worker.
+        """
+        backend = self._backends.get(display.name)
+        if backend is None:
+            bus, info = display.resolve()
+            if info is not None:
+                self._unprobed[display.name] = info
+            else:
+                # A display given by bus only is still cached under the EDID found there.
+                info = discovery.monitor_on_bus(bus)
+            entry = self.capabilities.get(info) if info else None
+            quirks = entry.get("quirks", {}) if entry else {}
+            backend = self.backend_factory(bus, self.backend_name, self.ddcutil_command, quirks)
+            if info is not None:
+                self._info[display.name] = info
+            else:
+                self._info.pop(display.name, None)
+            if "switch_settle" in quirks:
+                self._settle[display.name] = self._saved_settle[display.name] = quirks["switch_settle"]
+            if quirks.get("verify") is False:
+                self._unverifiable.add(display.name)
+            logger.info(f"{display.name}: using {backend.name} DDC backend on bus {bus}")
+            self._backends[display.name] = backend
+        return backend
+
+    def buses(self) -> list:
+        """Return the current i2c bus of every display."""
+        return [display.resolve()[0] for display in self.displays.values()]
+
+    def reset(self) -> None:
+        """Drop backends of EDID-named displays so their bus is looked up again.
+
+        Bus-only displays are dropped too once a monitor was found on their
+        bus, since another one may be plugged in there now.
+        """
+        with self._lock:
+            for display in self.displays.values():
+                if (display.spec or display.name in self._info) and display.name in self._backends:
+                    backend = self._backends.pop(display.name)
+                    self._worker(backend.bus).submit(CONTROL, next(self._seq), backend.close)
+
+    def _worker(self, bus: str) -> BusWorker:
+        worker = self._workers.get(bus)
+        if worker is None:
+            worker = BusWorker(bus)
+            self._workers[bus] = worker
+        return worker
+
+    def read_current_input(self, backend):
+        """Return the monitor's current input, from the cache when still fresh."""
+        current = self.input_cache.get(backend.bus)
+        if current is None:
+            try:
+                with metrics.span("ddc_read"):
+                    current, _ = backend.get_vcp(ddc.VCP_INPUT_SOURCE)
+            except Exception as e:
+                logger.warning(f"Could not read current input on bus {backend.bus}: {e}")
+                return None
+            self.input_cache.set(backend.bus, current)
+        return current
+
+    def _apply_profile(self, backend, values: dict) -> int:
+        """Write the profile values the monitor does not have yet; returns how many."""
+        try:
+            current = backend.get_vcps(list(values))
+        except Exception as e:
+            logger.warning(f"Could not read profile settings on bus {backend.bus}: {e}")
+            current = {}
+        changes = {code: value for code, value in values.items() if current.get(code) != value}
+        if changes:
+            backend.set_vcps(changes)
+        return len(changes)
+
+    def _queued_backend(self, name: str, bus: str):
+        """Return the backend for a command on ``name`` that was queued on ``bus``.
+
+        Looked up when the command runs, so a backend that ``reset()`` or
+        ``set_displays()`` closed in the meantime is not reopened.
+        """
+        with self._lock:
+            display = self.displays.get(name)
+            if display is None:
+                raise ddc.DdcError(f"monitor '{name}' is no longer configured")
+            backend = self.backend_for(display)
+        if backend.bus != bus:
+            raise ddc.DdcError(f"monitor moved to bus {backend.bus} while the command was queued on bus {bus}")
+        return backend
+
+    def _switch_one(self, name: str, bus: str, input_code: str, values: dict, seq: int,
+                    queued: float) -> SwitchResult:
+        result = SwitchResult(name, bus, input_code)
+        start = time.perf_counter()
+        metrics.observe("queue", start - queued)
+        if self._latest.get(name) != seq:
+            result.superseded = True
+            metrics.inc("switch_superseded_total")
+            return result
+        try:
+            backend = self._queued_backend(name, bus)
+            info = self._unprobed.pop(name, None)
+            if info is not None:
+                entry = self.capabilities.ensure(info, backend)
+                logger.info(f"{name}: {info.key} on {info.connector}, inputs {entry['input_codes']}")
+            value = ddc.parse_vcp_value(input_code)
+            if self.read_current_input(backend) == value:
+                result.skipped = True
+                metrics.inc("switch_skipped_total")
+            else:
+                with metrics.span("ddc_write"):
+                    backend.set_vcp(ddc.VCP_INPUT_SOURCE, value)
+                metrics.inc("switches_total")
+                if self.verify_timeout > 0 and name not in self._unverifiable:
+                    with metrics.span("verify"):
+                        result.retries = self._verify(name, backend, value)
+                self.input_cache.set(backend.bus, value)
+            if values:
+                with metrics.span("profile"):
+                    result.adjusted = self._apply_profile(backend, values)
+        except Exception as e:
+            self.input_cache.invalidate(bus)
+            result.ok = False
+            result.error = e
+            metrics.inc("switch_failures_total")
+        result.duration = time.perf_counter() - start
+        return result
+
+    def _verify(self, name: str, backend, value: int) -> int:
+        """Read VCP 0x60 back until it shows ``value``, rewriting if it does not.
+
+        Returns the number of extra writes. Raises ``DdcError`` if the monitor
+        keeps reporting another input; a monitor that never answers the read
+        (some go quiet while they resync) is assumed to have switched.
+        """
+        settle = self._settle.get(name)
+        if settle is None:
+            settle = DEFAULT_SETTLE
+            rewrite_after = self.verify_timeout / 2
+        else:
+            rewrite_after = REWRITE_FACTOR * settle
+        written = start = time.perf_counter()
+        delay = settle
+        retries = 0
+        polls = 0
+        answered = False
+        while True:
+            time.sleep(delay)
+            delay = VERIFY_POLL
+            polls += 1
+            try:
+                current, _ = backend.get_vcp(ddc.VCP_INPUT_SOURCE)
+            except Exception:
+                current = None
+            now = time.perf_counter()
+            if current == value:
+                self._silent.pop(name, None)
+                self._learn(name, backend.bus, now - written, first_poll=polls == 1)
+                return retries
+            answered = answered or current is not None
+            if now - start >= self.verify_timeout:
+                if not answered:
+                    self._on_silent(name, backend.bus, now - written)
+                    return retries
+                raise ddc.DdcError(f"monitor still reports input {current} after {retries + 1} write(s)")
+            if current is not None and now - written >= rewrite_after and retries < self.max_retries:
+                backend.set_vcp(ddc.VCP_INPUT_SOURCE, value)
+                written = time.perf_counter()
+                retries += 1
+                polls = 0
+                delay = settle
+                metrics.inc("switch_retries_total")
+
+    def _on_silent(self, name: str, bus: str, elapsed: float) -> None:
+        """Handle a verify window without any answer from the monitor.
+
+        The resync took at least ``elapsed``, so the settle time is raised
+        towards it; only repeated silence turns verification off.
+        """
+        silent = self._silent.get(name, 0) + 1
+        if silent < SILENT_SWITCHES:
+            self._silent[name] = silent
+            logger.info(f"{name}: monitor did not answer within {elapsed:.1f} s after switching")
+            self._learn(name, bus, elapsed, first_poll=False)
+            return
+        self._silent.pop(name, None)
+        logger.warning(f"{name}: monitor does not answer after {silent} switches, no longer verifying it")
+        self._unverifiable.add(name)
+        self._persist(name, bus, "verify", False)
+
+    def _learn(self, name: str, bus: str, observed: float, first_poll: bool) -> None:
+        """Update the settle time estimate and persist it once it moved enough."""
+        settle = self._settle.get(name, DEFAULT_SETTLE)
+        if first_poll:
+            # Already switched at the first read-back; try a little sooner next time.
+            settle *= 1 - SETTLE_SMOOTHING / 2
+        else:
+            settle += SETTLE_SMOOTHING * (observed - settle)
+        settle = round(max(MIN_SETTLE, settle), 3)
+        self._settle[name] = settle
+        saved = self._saved_settle.get(name)
+        if saved is None or abs(settle - saved) > 0.2 * saved:
+            self._saved_settle[name] = settle
+            self._persist(name, bus, "switch_settle", settle)
+
+    def _persist(self, name: str, bus: str, quirk: str, value) -> None:
+        """Save a learned quirk to the capabilities cache once the bus is idle.
+
+        Runs on the bus worker. Once ``shutdown()`` stopped that worker the
+        quirk is saved right away instead, so no new worker is started.
+        """
+        info = self._info.get(name)
+        if info is None:
+            return
+        save = partial(self.capabilities.set_quirk, info, quirk, value)
+        with self._lock:
+            if bus not in self._stopping:
+                self._worker(bus).submit(HOUSEKEEPING, next(self._seq), save)
+                return
+        save()
+
+    def submit(self, targets: dict, priority: int = AUTOMATIC, profiles: dict = None) -> SwitchBatch:
+        """Queue a switch of each display in ``targets`` and return at once.
+
+        ``profiles`` maps display names to extra ``{vcp code: value}`` settings
+        applied in the same pass on the bus. Any queued command for the same
+        display that has not started yet is superseded by this one.
+        """
+        profiles = profiles or {}
+        batch = SwitchBatch()
+        for name, input_code in targets.items():
+            with self._lock:
+                try:
+                    backend = self.backend_for(self.displays[name])
+                except Exception as e:
+                    batch._add_result(SwitchResult(name, None, input_code, ok=False, error=e))
+                    continue
+                seq = next(self._seq)
+                self._latest[name] = seq
+                worker = self._worker(backend.bus)
+            batch._track(worker.submit(priority, seq, partial(
+                self._switch_one, name, backend.bus, input_code, profiles.get(name), seq, time.perf_counter())))
+        batch._seal()
+        return batch
+
+    def _read_one(self, name: str, bus: str) -> int:
+        backend = self._queued_backend(name, bus)
+        value, _ = backend.get_vcp(ddc.VCP_INPUT_SOURCE)
+        self.input_cache.set(backend.bus, value)
+        return value
+
+    def query(self, names=None) -> dict:
+        """Read the current input of each display on its bus worker.
+
+        Returns ``{name: Future}``; each future resolves to the VCP 0x60 value.
+        """
+        futures = {}
+        for name in names or list(self.displays):
+            with self._lock:
+                try:
+                    backend = self.backend_for(self.displays[name])
+                except Exception as e:
+                    futures[name] = Future()
+                    futures[name].set_exception(e)
+                    continue
+                worker = self._worker(backend.bus)
+                seq = next(self._seq)
+            futures[name] = worker.submit(MANUAL, seq, partial(self._read_one, name, backend.bus))
+        return futures
+
+    def ping(self) -> list:
+        """Queue a no-op on the bus of every display and return the futures.
+
+        Backends are opened on the way. The no-op runs as soon as the bus
+        finishes its current command, so a future that stays pending means a
+        DDC call is stuck.
+        """
+        futures = {}
+        with self._lock:
+            for display in self.displays.values():
+                try:
+                    bus = self.backend_for(display).bus
+                except Exception:
+                    # Reported by the next switch; nothing can hang here.
+                    continue
+                if bus not in futures:
+                    futures[bus] = self._worker(bus).submit(CONTROL, next(self._seq), lambda: None)
+        return list(futures.values())
+
+    def set_displays(self, displays, backend_name: str = None) -> None:
+        """Replace the display list, closing backends of removed or moved displays.
+
+        A different ``backend_name`` closes every backend so the next command
+        reopens it with the new kind.
+        """
+        with self._lock:
+            previous = self.displays
+            self.displays = {display.name: display for display in displays}
+            changed = backend_name is not None and backend_name != self.backend_name
+            if backend_name is not None:
+                self.backend_name = backend_name
+            for name in list(self._backends):
+                old, new = previous.get(name), self.displays.get(name)
+                if changed or new is None or (old.bus, old.spec) != (new.bus, new.spec):
+                    backend = self._backends.pop(name)
+                    self._worker(backend.bus).submit(CONTROL, next(self._seq), backend.close)
+
+    def apply(self, targets: dict, priority: int = AUTOMATIC, profiles: dict = None) -> tuple:
+        """Switch and wait; returns ``(results, total_seconds)``."""
+        return self.submit(targets, priority, profiles).wait()
+
+    def _close_bus(self, bus: str) -> None:
+        with self._lock:
+            for name, backend in list(self._backends.items()):
+                if backend.bus == bus:
+                    del self._backends[name]
+                    backend.close()
+
+    def shutdown(self) -> None:
+        """Stop the bus workers; each closes its backends after its queued commands."""
+        with self._lock:
+            for bus, worker in self._workers.items():
+                worker.stop(partial(self._close_bus, bus))
+                self._stopping.add(bus)
+            self._workers.clear()
+            # Only a backend whose bus never had a worker is safe to close here.
+            for name, backend in list(self._backends.items()):
+                if backend.bus not in self._stopping:
+                    del self._backends[name]
+                    backend.close()
@@ -0,0 +1,92 @@
+"""systemd ``Type=notify`` readiness and watchdog, without libsystemd.
+
+``notify()`` is a small sd_notify(3): one datagram to ``$NOTIFY_SOCKET``,
+and a no-op when the daemon was not started by systemd. The ``Notifier``
+service sends ``READY=1`` once detection runs and every display's DDC bus
+worker has answered, and then ``WATCHDOG=1`` from the event loop itself,
+only while each bus worker keeps completing a no-op queued behind its
+current command. A blocked loop or a wedged i2c call therefore stops the
+pings and systemd restarts the service after ``WatchdogSec``.
+"""
+import asyncio
+import logging
+import os
+import socket
+
+logger = logging.getLogger("usb_monitor")
+
+
+def notify(*fields: str) -> bool:
+    """Send ``fields`` (e.g. ``"READY=1"``) to systemd; False if not supervised."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # Abstract namespace socket.
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.sendto("\n".join(fields).encode("utf-8"), address)
+    except OSError as e:
+        logger.warning(f"sd_notify failed: {e}")
+        return False
+    return True
+
+
+def watchdog_interval():
+    """Return ``WatchdogSec`` in seconds if the watchdog applies to this process, else None.
+
+    The PyInstaller one-file bootloader is the service's main process and
+    runs the daemon as its child, so the parent's PID is accepted too.
+    """
+    pid = os.environ.get("WATCHDOG_PID")
+    if pid and pid not in (str(os.getpid()), str(os.getppid())):
+        return None
+    try:
+        usec = int(os.environ.get("WATCHDOG_USEC", ""))
+    except ValueError:
+        return None
+    return usec / 1_000_000 if usec > 0 else None
+
+
+class Notifier:
+    """core.Daemon service reporting readiness and liveness to systemd."""
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.loop = None
+        self._timer = None
+        self._interval = None
+        self._pending = []
+        self._stuck = False
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        if not os.environ.get("NOTIFY_SOCKET"):
+            return
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in self.daemon.engine.ping()))
+        notify("READY=1", f"STATUS=Watching {len(self.daemon.engine.displays)} monitor(s), "
+                          f"detection {self.daemon.detector.mode}")
+        logger.info("Reported readiness to systemd")
+        self._interval = watchdog_interval()
+        if self._interval:
+            # systemd recommends pinging at half the timeout.
+            self._timer = self.loop.call_later(self._interval / 2, self._on_watchdog)
+
+    def _on_watchdog(self) -> None:
+        if all(future.done() for future in self._pending):
+            if self._stuck:
+                logger.info("DDC bus workers are responsive again")
+                self._stuck = False
+            notify("WATCHDOG=1")
+            self._pending = self.daemon.engine.ping()
+        elif not self._stuck:
+            logger.warning("A DDC bus worker is stuck, withholding the systemd watchdog ping")
+            self._stuck = True
+        self._timer = self.loop.call_later(self._interval / 2, self._on_watchdog)
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        notify("STOPPING=1")
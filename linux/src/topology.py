@@ -0,0 +1,67 @@
+"""Early switching from the USB hub topology.
+
+A USB switch announces its own hub first; the devices behind it only show up,
+with their IDs filled in by udev, hundreds of milliseconds later. The index
+remembers the sysfs port chain every rule-matching device was seen under
+(``.../usb1/1-1/1-1.4/1-1.4.2`` lives under the ports ``1-1`` and ``1-1.4``).
+When a hub on that chain is added again, the daemon marks the device's keys
+present ahead of time under the device's own sysfs path, so the rules react
+to the hub's uevent. The device's real uevent then replaces the prediction
+without a presence change; if it does not arrive in time the prediction is
+withdrawn.
+"""
+import re
+
+# sysfs names of USB ports: bus-port[.port...]; root hubs are ``usbN``.
+PORT_RE = re.compile(r"^\d+-\d+(\.\d+)*$")
+
+
+def port_chain(sys_path: str) -> list:
+    """Return the sysfs paths of the hubs ``sys_path`` sits behind, outermost first."""
+    parts = sys_path.split("/")
+    return ["/".join(parts[:i + 1]) for i in range(len(parts) - 1) if PORT_RE.match(parts[i])]
+
+
+class TopologyIndex:
+    """Where rule-matching devices were last seen, indexed by their upstream hubs."""
+
+    def __init__(self):
+        # device sys_path -> presence keys
+        self._leaves = {}
+        # hub sys_path -> device sys_paths behind it
+        self._hubs = {}
+
+    def __len__(self) -> int:
+        return len(self._leaves)
+
+    def learn(self, sys_path: str, keys: tuple, watched: bool) -> None:
+        """Remember a present device if a rule matches it, forget the path otherwise."""
+        if not watched:
+            self.forget(sys_path)
+            return
+        if self._leaves.get(sys_path) == keys:
+            return
+        self.forget(sys_path)
+        self._leaves[sys_path] = keys
+        for hub in port_chain(sys_path):
+            self._hubs.setdefault(hub, set()).add(sys_path)
+
+    def forget(self, sys_path: str) -> None:
+        if self._leaves.pop(sys_path, None) is None:
+            return
+        for hub in port_chain(sys_path):
+            leaves = self._hubs.get(hub)
+            if leaves is not None:
+                leaves.discard(sys_path)
+                if not leaves:
+                    del self._hubs[hub]
+
+    def refresh(self, watched) -> None:
+        """Drop devices that ``watched(keys)`` no longer cares about, e.g. after new rules."""
+        for sys_path, keys in list(self._leaves.items()):
+            if not watched(keys):
+                self.forget(sys_path)
+
+    def behind(self, hub: str) -> list:
+        """Return ``(sys_path, keys)`` for every known device behind ``hub``."""
+        return [(sys_path, self._leaves[sys_path]) for sys_path in self._hubs.get(hub, ())]
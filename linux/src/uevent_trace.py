@@ -0,0 +1,278 @@
+"""Capture and replay of uevent traces.
+
+A trace is a JSON Lines file (gzip-compressed when the name ends in
+``.gz``) holding the settings in use, the devices present at startup, every
+uevent with its time offset, and the decisions the daemon took: committed
+rules, switch targets and DDC results. Devices are stored as compact lists
+(see ``encode_device``).
+
+Replay feeds the uevents back through the presence index, rules and debounce
+scheduler at real or accelerated speed, switching fake monitors, and checks
+that the same rules and switch targets come out in the same order.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+
+import config
+import core
+import ddc
+import discovery
+import metrics
+import presence
+import scheduler
+import switching
+
+logger = logging.getLogger("usb_monitor")
+
+TRACE_VERSION = 1
+DEVICE_FIELDS = ("ID_VENDOR_ID", "ID_MODEL_ID", "ID_SERIAL_SHORT")
+
+
+def open_trace(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def encode_device(device) -> list:
+    """Return ``[action, subsystem, device_type, sys_path, vid, pid, serial]``."""
+    return [device.action, device.subsystem, device.device_type, device.sys_path] + [
+        device.get(field, "") for field in DEVICE_FIELDS
+    ]
+
+
+class TraceDevice:
+    """A recorded uevent that quacks like ``pyudev.Device``."""
+
+    __slots__ = ("action", "subsystem", "device_type", "sys_path", "properties")
+
+    def __init__(self, action, subsystem, device_type, sys_path, *values):
+        self.action = action
+        self.subsystem = subsystem
+        self.device_type = device_type
+        self.sys_path = sys_path
+        self.properties = dict(zip(DEVICE_FIELDS, values))
+
+    def get(self, key: str, default=None):
+        return self.properties.get(key) or default
+
+
+class TraceRecorder:
+    """Append trace records; pass ``path=None`` to keep them in memory only."""
+
+    def __init__(self, path: str = None, config: dict = None):
+        self.path = path
+        self.records = []
+        self._start = time.monotonic()
+        self._file = open_trace(path, "w") if path else None
+        self._write({"k": "header", "version": TRACE_VERSION, "started": time.time(), "config": config or {}})
+
+    def _write(self, record: dict) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        else:
+            self.records.append(record)
+
+    def _now(self) -> float:
+        return round(time.monotonic() - self._start, 4)
+
+    def seed(self, devices) -> None:
+        self._write({"k": "seed", "t": self._now(), "devices": [encode_device(d) for d in devices]})
+
+    def uevent(self, device) -> None:
+        self._write({"k": "uevent", "t": self._now(), "d": encode_device(device)})
+
+    def rule(self, rule) -> None:
+        self._write({"k": "rule", "t": self._now(), "rule": rule.name if rule else None})
+
+    def switch(self, targets: dict, priority: int) -> None:
+        self._write({"k": "switch", "t": self._now(), "targets": targets, "priority": priority})
+
+    def results(self, batch) -> None:
+        for result in batch.results:
+            self._write({
+                "k": "ddc", "t": self._now(), "monitor": result.name, "input": result.input_code,
+                "ok": result.ok, "skipped": result.skipped, "ms": round(result.duration * 1000, 1),
+                "error": str(result.error) if result.error else None,
+            })
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_trace(path: str) -> list:
+    with open_trace(path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records or records[0].get("k") != "header":
+        raise ValueError(f"{path} is not a USB monitor trace")
+    if records[0].get("version") != TRACE_VERSION:
+        raise ValueError(f"Unsupported trace version {records[0].get('version')}")
+    return records
+
+
+def decisions(records) -> list:
+    """Return the committed rules and automatic switch targets, in order."""
+    found = []
+    for record in records:
+        if record["k"] == "rule":
+            found.append(("rule", record["rule"]))
+        elif record["k"] == "switch" and record["priority"] == switching.AUTOMATIC:
+            found.append(("switch", record["targets"]))
+    return found
+
+
+class ReplaySource:
+    """Plays recorded uevents; serves as both the udev context and detector."""
+
+    mode = "replay"
+
+    def __init__(self, seed_devices):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        self._pending = []
+        # uevents handed to the daemon so far.
+        self.delivered = 0
+        self.present = {device.sys_path: device for device in seed_devices}
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    def emit(self, device) -> None:
+        if device.subsystem == "usb":
+            if device.action in presence.REMOVE_ACTIONS:
+                self.present.pop(device.sys_path, None)
+            else:
+                self.present[device.sys_path] = device
+        self._pending.append(device)
+        os.write(self._write_fd, b"\0")
+
+    def read_pending(self) -> list:
+        try:
+            os.read(self._read_fd, 4096)
+        except BlockingIOError:
+            pass
+        devices, self._pending = self._pending, []
+        self.delivered += len(devices)
+        return devices
+
+    def list_devices(self, **filters):
+        return list(self.present.values())
+
+    def close(self) -> None:
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class DryRunBackend:
+    """Records DDC writes instead of talking to a monitor."""
+
+    name = "dry-run"
+
+    def __init__(self, bus, *args):
+        self.bus = str(bus)
+        self.values = {}
+
+    def get_vcp(self, code: int) -> tuple:
+        return self.values.get(code), 0xFF
+
+    def set_vcp(self, code: int, value: int) -> None:
+        self.values[code] = value
+
+    def get_vcps(self, codes) -> dict:
+        return {code: self.values[code] for code in codes if code in self.values}
+
+    def set_vcps(self, values: dict) -> None:
+        self.values.update(values)
+
+    def get_capabilities(self) -> str:
+        raise ddc.DdcError("Capabilities are not available during replay")
+
+    def close(self) -> None:
+        pass
+
+
+async def _replay(records, speed: float) -> dict:
+    settings = config.Config(records[0]["config"])
+    seed = next((r for r in records if r["k"] == "seed"), {"t": 0.0, "devices": []})
+    events = [r for r in records if r["k"] == "uevent"]
+    source = ReplaySource([TraceDevice(*d) for d in seed["devices"]])
+    for display in settings.displays:
+        # Replay never looks at the local sysfs or i2c buses.
+        display.spec = ""
+    input_cache = ddc.InputStateCache(0)
+    engine = switching.SwitchEngine(settings.displays, "dry-run", "", input_cache,
+                                    discovery.CapabilitiesCache(os.devnull), backend_factory=DryRunBackend)
+    daemon = core.Daemon(
+        source,
+        presence.PresenceIndex(),
+        settings.ruleset,
+        scheduler.SwitchScheduler(settings.settle_time / speed, settings.switch_hold / speed),
+        engine,
+        input_cache,
+        reconcile_interval=0,
+        ready_timeout=0,
+        detector=source,
+        hub_confirm_timeout=settings.hub_confirm_timeout / speed,
+    )
+    daemon.tracer = TraceRecorder()
+    start = time.monotonic()
+    await daemon.start()
+    loop = asyncio.get_running_loop()
+    for event in events:
+        loop.call_later((event["t"] - seed["t"]) / speed, source.emit, TraceDevice(*event["d"]))
+    if events:
+        await asyncio.sleep((events[-1]["t"] - seed["t"]) / speed)
+    # Let the daemon read the last uevents, then let the last debounce window
+    # expire and its switch complete.
+    while source.delivered < len(events):
+        await asyncio.sleep(0.001)
+    while daemon.scheduler.deadline is not None or daemon.pending_switches:
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - start
+    daemon.close()
+    source.close()
+    return {"elapsed": elapsed, "records": daemon.tracer.records}
+
+
+def rule_offsets(records) -> list:
+    """Return when each rule was committed, in seconds after the startup enumeration."""
+    seed = next((r["t"] for r in records if r["k"] == "seed"), 0.0)
+    return [r["t"] - seed for r in records if r["k"] == "rule"]
+
+
+def replay(path: str, speed: float = 1.0) -> dict:
+    """Replay the trace at ``path`` and compare decisions with the capture."""
+    records = load_trace(path)
+    metrics.registry.reset()
+    outcome = asyncio.run(_replay(records, speed))
+    expected, actual = decisions(records), decisions(outcome["records"])
+    mismatches = [
+        {"index": i, "captured": e, "replayed": a}
+        for i, (e, a) in enumerate(zip(expected, actual)) if e != a
+    ]
+    if len(expected) != len(actual):
+        mismatches.append({"index": min(len(expected), len(actual)),
+                           "captured": expected[len(actual):], "replayed": actual[len(expected):]})
+    captured_rules = rule_offsets(records)
+    replayed_rules = rule_offsets(outcome["records"])
+    return {
+        "trace": path,
+        "speed": speed,
+        "uevents": sum(1 for r in records if r["k"] == "uevent"),
+        "decisions": len(expected),
+        "match": not mismatches,
+        "mismatches": mismatches,
+        "captured_seconds": round(records[-1].get("t", 0.0), 3),
+        "replay_seconds": round(outcome["elapsed"], 3),
+        "rule_offsets_ms": [
+            {"captured": round(c * 1000, 1), "replayed": round(r * speed * 1000, 1)}
+            for c, r in zip(captured_rules, replayed_rules)
+        ],
+        "stages_ms": metrics.registry.percentiles(),
+    }
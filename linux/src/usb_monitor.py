@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import os
 import logging
-from logging.handlers import RotatingFileHandler
 
 # Configure environment for Wayland sessions when available
 if os.environ.get("XDG_SESSION_TYPE") == "wayland" or os.environ.get("WAYLAND_DISPLAY"):
@@ -9,25 +8,47 @@ if os.environ.get("XDG_SESSION_TYPE") == "wayland" or os.environ.get("WAYLAND_DI
     os.environ.setdefault("GDK_BACKEND", "wayland")
     os.environ.setdefault("QT_QPA_PLATFORM", "wayland")
 
+import argparse
+import asyncio
+import signal
 import sys
-import time
 import json
 import subprocess
 import threading
 
 import pyudev
-from PIL import Image
-import tkinter as tk
-from tkinter import messagebox
+
+import config
+import control
+import core
+import ddc
+import discovery
+import history
+import icons
+import logqueue
+import metrics
+import presence
+import scheduler
+import settings_watcher
+import state
+import switching
+import systemd_notify
+import uevent_trace
 
 # Basic paths
 LOCK_FILE = os.path.join(os.path.dirname(__file__), "usb_monitor.lock")
 APP_DATA = os.path.expanduser("~/.config/USBMonitor")
 LOG_FILE = os.path.join(APP_DATA, "logs", "switch_log.txt")
 SETTINGS_FILE = os.path.join(APP_DATA, "settings.json")
+CAPABILITIES_FILE = os.path.join(APP_DATA, "monitors.json")
+# Pre-sized tray icons from crop_image.py; the full artwork is the fallback.
+ICON_DIR = os.path.join(os.path.dirname(__file__), "icons")
+TRAY_ICON_SIZE = 64
 
 icon = None
 current_manual_state = False
+# Set when the tray's event loop thread dies, so the process exits with an error.
+loop_crashed = False
 
 DDCUTIL_CMD = "ddcutil"
 
@@ -35,21 +56,11 @@ DDCUTIL_CMD = "ddcutil"
 logger = None
 
 def setup_logging() -> None:
-    """Initialize rotating file logging."""
+    """Initialize rotating file logging on a background writer thread."""
     global logger
     log_dir = os.path.join(APP_DATA, "logs")
     os.makedirs(log_dir, exist_ok=True)
-    logger = logging.getLogger("usb_monitor")
-    if not logger.handlers:
-        logger.setLevel(logging.INFO)
-        handler = RotatingFileHandler(
-            LOG_FILE, maxBytes=1024 * 1024, backupCount=3, encoding="utf-8"
-        )
-        formatter = logging.Formatter(
-            "%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S"
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+    logger = logqueue.start(LOG_FILE)
 
 def is_wayland() -> bool:
     """Return True if running under a Wayland session."""
@@ -80,6 +91,8 @@ def log_event(message: str, level: int = logging.INFO) -> None:
 
 def open_log_file():
     """Open the log file using the user's preferred editor or default handler."""
+    if not is_headless():
+        from tkinter import messagebox
     if not os.path.exists(LOG_FILE):
         if is_headless():
             print("Log file not found.")
@@ -111,7 +124,9 @@ def ensure_settings_file():
                 "monitor_bus": "1",
                 "keyboard_id": "046d:c31c",
                 "input_connected": "15",
-                "input_disconnected": "18"
+                "input_disconnected": "18",
+                "detection_mode": "udev",
+                "ddc_backend": "native",
             }
             with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
                 json.dump(default_config, f, indent=4)
@@ -125,10 +140,15 @@ def show_settings_popup():
         "keyboard_id": "046d:c31c",
         "input_connected": "15",
         "input_disconnected": "18",
+        "detection_mode": "udev",
+        "ddc_backend": "native",
+        "monitor": "",
     }
     if is_headless():
         print("Headless environment detected. Skipping settings popup.")
         return
+    import tkinter as tk
+    from tkinter import messagebox
     if os.path.exists(SETTINGS_FILE):
         try:
             with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
@@ -137,12 +157,16 @@ def show_settings_popup():
             pass
 
     def save_settings():
-        settings = {
+        settings = dict(existing)
+        settings.update({
             "monitor_bus": monitor_bus_entry.get().strip(),
             "keyboard_id": keyboard_id_entry.get().strip(),
             "input_connected": input_connected_entry.get().strip(),
             "input_disconnected": input_disconnected_entry.get().strip(),
-        }
+            "detection_mode": detection_mode_var.get(),
+            "ddc_backend": ddc_backend_var.get(),
+            "monitor": monitor_var.get(),
+        })
         os.makedirs(APP_DATA, exist_ok=True)
         with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
             json.dump(settings, f, indent=4)
@@ -178,116 +202,223 @@ def show_settings_popup():
     input_disconnected_entry.insert(0, existing.get("input_disconnected"))
     input_disconnected_entry.grid(row=3, column=1, **padding)
 
-    tk.Button(root, text="Save", width=20, command=save_settings).grid(row=4, column=0, columnspan=2, pady=12)
+    tk.Label(root, text="Detection Mode:").grid(row=4, column=0, sticky="w", **padding)
+    detection_mode_var = tk.StringVar(root, existing.get("detection_mode", "udev"))
+    tk.OptionMenu(root, detection_mode_var, "udev", "poll").grid(row=4, column=1, sticky="w", **padding)
+
+    tk.Label(root, text="DDC Backend:").grid(row=5, column=0, sticky="w", **padding)
+    ddc_backend_var = tk.StringVar(root, existing.get("ddc_backend", "native"))
+    tk.OptionMenu(root, ddc_backend_var, "native", "ddcutil").grid(row=5, column=1, sticky="w", **padding)
+
+    tk.Label(root, text="Monitor (by EDID):").grid(row=6, column=0, sticky="w", **padding)
+    detected = [""] + [info.key for info in discovery.list_monitors()]
+    monitor_var = tk.StringVar(root, existing.get("monitor", ""))
+    tk.OptionMenu(root, monitor_var, *detected).grid(row=6, column=1, sticky="w", **padding)
+
+    tk.Button(root, text="Save", width=20, command=save_settings).grid(row=7, column=0, columnspan=2, pady=12)
 
     root.mainloop()
 
 
-def load_config():
+def load_config() -> config.Config:
     ensure_settings_file()
-    with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return config.load(SETTINGS_FILE)
 
 
-CONFIG = load_config()
-MONITOR_BUS = CONFIG.get("monitor_bus", "1")
-KEYBOARD_IDENTIFIER = CONFIG.get("keyboard_id", "046d:c31c").lower()
-INPUT_WHEN_CONNECTED = CONFIG.get("input_connected", "15")
-INPUT_WHEN_DISCONNECTED = CONFIG.get("input_disconnected", "18")
+# Configuration and the daemon core, set up by init().
+CONFIG = None
 
-context = pyudev.Context()
+daemon = None
 
 
-def is_keyboard_connected() -> bool:
-    for device in context.list_devices(subsystem="usb"):
-        vid = device.get("ID_VENDOR_ID", "")
-        pid = device.get("ID_MODEL_ID", "")
-        if f"{vid}:{pid}".lower() == KEYBOARD_IDENTIFIER:
-            return True
-    return False
+def init() -> None:
+    """Load settings and build the detection and switching objects."""
+    global CONFIG, daemon
+    CONFIG = load_config()
+    logqueue.set_format(CONFIG.log_format)
+    input_cache = ddc.InputStateCache(CONFIG.input_cache_ttl)
+    switch_history = history.History(CONFIG.history_size, CONFIG.history_file)
+    switch_history.load()
+    engine = switching.SwitchEngine(
+        CONFIG.displays, CONFIG.ddc_backend, DDCUTIL_CMD,
+        input_cache, discovery.CapabilitiesCache(CAPABILITIES_FILE),
+        verify_timeout=CONFIG.verify_timeout, max_retries=CONFIG.switch_retries,
+    )
+    daemon = core.Daemon(
+        pyudev.Context(),
+        presence.PresenceIndex(),
+        CONFIG.ruleset,
+        scheduler.SwitchScheduler(CONFIG.settle_time, CONFIG.switch_hold),
+        engine,
+        input_cache,
+        detection_mode=CONFIG.detection_mode,
+        poll_interval=CONFIG.poll_interval,
+        reconcile_interval=CONFIG.reconcile_interval,
+        hub_confirm_timeout=CONFIG.hub_confirm_timeout,
+        history=switch_history,
+        ready_timeout=CONFIG.ready_timeout,
+        metrics_textfile=CONFIG.metrics_textfile,
+        profiles=CONFIG.profiles,
+        idle_profile=CONFIG.idle_profile,
+        state=state.StateFile(state.default_path(APP_DATA)),
+        config_digest=CONFIG.digest,
+    )
+    watcher = settings_watcher.SettingsWatcher(SETTINGS_FILE, apply_config)
+    daemon.add_service(watcher)
+    daemon.add_service(control.ControlServer(daemon, watcher.reload))
+    # Last, so READY=1 also covers the settings watcher and control socket.
+    daemon.add_service(systemd_notify.Notifier(daemon))
 
 
-def switch_input(input_code: str):
-    try:
-        subprocess.run([DDCUTIL_CMD, "--bus", MONITOR_BUS, "setvcp", "60", str(input_code)], check=True)
-        log_event(f"Switched input to {input_code}")
-    except Exception as e:
-        log_event(f"Failed to switch input: {e}")
+def apply_config(new_config: config.Config) -> None:
+    """Swap a validated config into the running daemon; runs on its loop."""
+    global CONFIG
+    if new_config.digest == CONFIG.digest:
+        return
+    logqueue.set_format(new_config.log_format)
+    daemon.reconfigure(new_config)
+    theme_changed = new_config.tray_theme != CONFIG.tray_theme
+    CONFIG = new_config
+    if icon is not None and theme_changed:
+        icon.icon = tray_image("connected" if current_manual_state else "disconnected")
+    log_event("Settings reloaded")
+
+
+def show_history():
+    """Show today's and overall switch statistics and the latest switches."""
+    summary = daemon.history.summary() or "No switches yet."
+    if is_headless():
+        print(summary)
+        return
+    from tkinter import messagebox
+    messagebox.showinfo("USB Monitor - Switch History", summary)
 
 
 def toggle_input(icon_obj, item):
     global current_manual_state, icon
     current_manual_state = not current_manual_state
+    daemon.call_threadsafe(daemon.switch_state, current_manual_state, switching.MANUAL)
     if current_manual_state:
-        switch_input(INPUT_WHEN_CONNECTED)
         icon.title = "USB Monitor (Connected)"
     else:
-        switch_input(INPUT_WHEN_DISCONNECTED)
         icon.title = "USB Monitor (Disconnected)"
+    icon.icon = tray_image("connected" if current_manual_state else "disconnected")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Switch monitor inputs when USB devices come and go.")
+    parser.add_argument("--oneshot", action="store_true",
+                        help="switch once for the devices present now and exit")
+    parser.add_argument("--profile", action="store_true",
+                        help="print per-stage latency percentiles on exit")
+    parser.add_argument("--capture", metavar="TRACE",
+                        help="record uevents and switch decisions to TRACE (.gz to compress)")
+    parser.add_argument("--replay", metavar="TRACE",
+                        help="replay TRACE against fake monitors, check the decisions and exit")
+    parser.add_argument("--replay-speed", type=float, default=1.0, metavar="FACTOR",
+                        help="replay FACTOR times faster than captured (default 1)")
+    return parser.parse_args(argv)
+
+
+def tray_image(state: str):
+    """Return the tray image for ``state`` in the configured theme, already at tray size."""
+    from PIL import Image
+    path = icons.icon_path(icons.load_manifest(ICON_DIR), ICON_DIR, CONFIG.tray_theme, state, TRAY_ICON_SIZE)
+    try:
+        return Image.open(path or os.path.join(os.path.dirname(__file__), "monitor_light.png"))
+    except Exception:
+        return Image.new("RGB", (TRAY_ICON_SIZE, TRAY_ICON_SIZE), color=(0, 0, 0))
 
 
-def main_loop():
-    last_state = None
-    time.sleep(10)
-    while True:
-        connected = is_keyboard_connected()
-        if last_state is None:
-            if connected:
-                switch_input(INPUT_WHEN_CONNECTED)
-            else:
-                switch_input(INPUT_WHEN_DISCONNECTED)
-            last_state = connected
-        elif connected != last_state:
-            if connected:
-                switch_input(INPUT_WHEN_CONNECTED)
-            else:
-                switch_input(INPUT_WHEN_DISCONNECTED)
-            last_state = connected
-        time.sleep(2)
-
-
-def create_tray_icon():
+def create_tray_icon() -> bool:
+    """Run the tray until it is closed; False if the event loop crashed."""
     from pystray import Icon, Menu, MenuItem
     global icon
-    icon_path = os.path.join(os.path.dirname(__file__), "monitor_light.png")
-    try:
-        image = Image.open(icon_path)
-    except Exception:
-        image = Image.new("RGB", (64, 64), color=(0, 0, 0))
+    image = tray_image("connected")
     menu = Menu(
         MenuItem("Switch Monitor Port", toggle_input),
         Menu.SEPARATOR,
-        MenuItem("Edit Settings", lambda icon, item: threading.Thread(target=show_settings_popup).start()),
-        MenuItem("Show Logs", lambda icon, item: threading.Thread(target=open_log_file).start()),
+        MenuItem("Edit Settings", lambda icon, item: daemon.run_blocking_threadsafe(show_settings_popup)),
+        MenuItem("Show Logs", lambda icon, item: daemon.run_blocking_threadsafe(open_log_file)),
+        MenuItem("Switch History", lambda icon, item: daemon.run_blocking_threadsafe(show_history)),
         Menu.SEPARATOR,
         MenuItem("Stop Service", quit_app),
     )
     icon = Icon("USBMonitor", image, "USB Monitor", menu)
-    threading.Thread(target=main_loop, daemon=True).start()
-    icon.run()
+    # pystray needs the main thread, so the event loop gets the only other one.
+    loop_thread = threading.Thread(target=run_tray_loop, args=(icon,), daemon=True)
+
+    def start_loop(icon):
+        # Started from pystray's setup hook so that icon.stop() is valid if the loop dies at once.
+        icon.visible = True
+        loop_thread.start()
+
+    icon.run(setup=start_loop)
+    loop_thread.join(timeout=5)
+    return not loop_crashed
+
+
+def run_tray_loop(icon):
+    """Run the daemon for the tray; if the loop crashes, log it and close the tray."""
+    global loop_crashed
+    try:
+        asyncio.run(daemon.run())
+    except Exception as e:
+        loop_crashed = True
+        log_event(f"Event loop crashed: {e}", level=logging.ERROR)
+        icon.stop()
 
 
 def quit_app(icon, item):
-    remove_lock_file()
+    daemon.stop_threadsafe()
     icon.stop()
-    sys.exit(0)
+
+
+async def run_headless():
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, daemon.stop)
+    await daemon.run()
 
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.replay:
+        report = uevent_trace.replay(args.replay, args.replay_speed)
+        print(json.dumps(report, indent=4))
+        sys.exit(0 if report["match"] else 1)
     check_single_instance()
     setup_logging()
     log_event("Script started")
+    exit_code = 0
     try:
-        if is_headless():
+        init()
+        if args.capture:
+            daemon.tracer = uevent_trace.TraceRecorder(args.capture, CONFIG.raw)
+            # A warm start's partial switch could not be reproduced by replay.
+            daemon.state = None
+            log_event(f"Capturing uevents to {args.capture}")
+        if args.oneshot:
+            exit_code = 0 if asyncio.run(daemon.run_once()) else 1
+        elif is_headless():
             log_event("Headless mode detected. Running monitor logic only.")
-            threading.Thread(target=main_loop, daemon=True).start()
-            while True:
-                time.sleep(60)  # Keep the script alive
-        else:
-            create_tray_icon()
+            asyncio.run(run_headless())
+            log_event("Script stopped.")
+        elif not create_tray_icon():
+            exit_code = 1
     except KeyboardInterrupt:
         log_event("Script terminated by user.")
+    except config.ConfigError as e:
+        log_event(f"Invalid settings in {SETTINGS_FILE}: {e}", level=logging.ERROR)
+        exit_code = 1
     except Exception as e:
         log_event(f"Script crashed: {e}")
+        exit_code = 1
     finally:
         remove_lock_file()
+        if args.profile:
+            report = json.dumps(metrics.registry.percentiles(), indent=4)
+            print(report)
+            log_event(f"Stage latency percentiles (ms):\n{report}")
+        logqueue.stop()
+    sys.exit(exit_code)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Command line client for the running USB monitor daemon.
+
+Usage:
+    usb_monitor_ctl.py status
+    usb_monitor_ctl.py query [MONITOR...]
+    usb_monitor_ctl.py switch connected|disconnected|RULE|INPUT_CODE [MONITOR...]
+    usb_monitor_ctl.py reload
+    usb_monitor_ctl.py metrics
+    usb_monitor_ctl.py history [COUNT]
+
+``metrics`` prints Prometheus text and ``history`` a plain text summary
+(``--json`` for the full reply with the last COUNT events); every other
+command prints the JSON reply.
+
+Sends one line to the daemon's control socket. Only the standard library's
+socket/json modules are imported, so it starts fast enough to bind to a
+hotkey.
+"""
+import json
+import os
+import socket
+import sys
+
+SOCKET_NAME = "usb_monitor.sock"
+TIMEOUT = 10.0
+
+
+def socket_path() -> str:
+    """Return the control socket path under $XDG_RUNTIME_DIR, or the config dir."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, SOCKET_NAME)
+    return os.path.join(os.path.expanduser("~/.config/USBMonitor"), SOCKET_NAME)
+
+
+def send(line: str, path: str = None) -> dict:
+    """Send one request line and return the decoded reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(TIMEOUT)
+        sock.connect(path or socket_path())
+        sock.sendall(line.encode("utf-8") + b"\n")
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    return json.loads(reply)
+
+
+def main(argv) -> int:
+    as_json = "--json" in argv
+    argv = [arg for arg in argv if arg != "--json"]
+    if not argv or argv[0] in ("-h", "--help"):
+        print(__doc__.strip())
+        return 0 if argv else 2
+    try:
+        reply = send(" ".join(argv))
+    except OSError as e:
+        print(f"Cannot reach USB monitor daemon at {socket_path()}: {e}", file=sys.stderr)
+        return 1
+    if argv[0] == "metrics" and "text" in reply:
+        sys.stdout.write(reply["text"])
+    elif argv[0] == "history" and "summary" in reply and not as_json:
+        print(reply["summary"])
+    else:
+        print(json.dumps(reply, indent=2))
+    return 0 if reply.get("ok") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,134 @@
+"""Daemon reactions to hub add/unbind/remove sequences, driven by bench/fakes.py.
+
+Needs pyudev (imported by the detection code); skipped without it.
+"""
+import asyncio
+import errno
+import os
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "src"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "bench"))
+
+try:
+    import core  # noqa: E402
+except ImportError:
+    core = None
+import ddc  # noqa: E402
+import discovery  # noqa: E402
+import metrics  # noqa: E402
+import presence  # noqa: E402
+import rules  # noqa: E402
+import scheduler  # noqa: E402
+import switching  # noqa: E402
+from fakes import FakeDevice, FakeUdev, backend_factory  # noqa: E402
+
+HUB_PATH = "/sys/devices/pci0000:00/0000:00:14.0/usb1/1-1"
+KEYBOARD_PATH = f"{HUB_PATH}/1-1.1"
+KEYBOARD = ("046d", "c31c")
+HUB = ("1a40", "0101")
+
+
+@unittest.skipIf(core is None, "pyudev is not installed")
+class HubSequenceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        metrics.registry.reset()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.udev = FakeUdev()
+        self.udev.emit(FakeDevice("add", HUB_PATH, *HUB))
+        self.udev.emit(FakeDevice("add", KEYBOARD_PATH, *KEYBOARD))
+        self.udev.read_pending()
+        config = {"keyboard_id": ":".join(KEYBOARD), "monitor_bus": "1"}
+        input_cache = ddc.InputStateCache(0)
+        engine = switching.SwitchEngine(
+            switching.load_displays(config), "fake", "", input_cache,
+            discovery.CapabilitiesCache(os.path.join(self.tmp.name, "monitors.json")),
+            backend_factory=backend_factory(0.0, 0.0, 0), verify_timeout=0,
+        )
+        self.daemon = core.Daemon(
+            self.udev, presence.PresenceIndex(), rules.RuleSet(rules.compile_rules(config)),
+            # A long settle window keeps every change after startup pending.
+            scheduler.SwitchScheduler(settle=60.0, hold=0.0), engine, input_cache,
+            reconcile_interval=0, ready_timeout=0, detector=self.udev, hub_confirm_timeout=3.0,
+        )
+        await self.daemon.start()
+        await asyncio.sleep(0.05)
+        self.keyboard_rule = self.daemon.scheduler.committed
+        self.assertEqual(self.keyboard_rule.name, "keyboard")
+
+    async def asyncTearDown(self):
+        self.daemon.close()
+        self.udev.close()
+        self.tmp.cleanup()
+
+    def send(self, action, sys_path, ids=()):
+        self.daemon.handle_device(FakeDevice(action, sys_path, *ids))
+
+    def unplug(self):
+        # The order the kernel uses when a hub goes away with its devices.
+        self.send("unbind", KEYBOARD_PATH)
+        self.send("remove", KEYBOARD_PATH)
+        self.send("unbind", HUB_PATH)
+        self.send("remove", HUB_PATH)
+
+    def test_unplug_does_not_predict(self):
+        self.unplug()
+        self.assertNotIn("046d:c31c", self.daemon.present_devices)
+        self.assertIsNone(self.daemon.scheduler.pending)
+        self.assertEqual(self.daemon.scheduler.flaps_suppressed, 0)
+        self.assertEqual(metrics.registry.counters.get("predictions_total", 0), 0)
+
+    def test_hub_unbind_keeps_switch_away_pending(self):
+        self.send("unbind", KEYBOARD_PATH)
+        self.send("remove", KEYBOARD_PATH)
+        deadline = self.daemon.scheduler.deadline
+        self.send("unbind", HUB_PATH)
+        self.assertEqual(self.daemon.scheduler.deadline, deadline)
+        self.assertEqual(self.daemon.scheduler.flaps_suppressed, 0)
+
+    def test_hub_add_predicts_known_device(self):
+        self.unplug()
+        self.send("add", HUB_PATH, HUB)
+        self.assertIn("046d:c31c", self.daemon.present_devices)
+        self.assertEqual(metrics.registry.counters.get("predictions_total", 0), 1)
+        # Back to the committed rule before the settle window closed.
+        self.assertEqual(self.daemon.scheduler.flaps_suppressed, 1)
+        self.send("add", KEYBOARD_PATH, KEYBOARD)
+        self.send("bind", KEYBOARD_PATH, KEYBOARD)
+        self.assertEqual(metrics.registry.counters.get("predictions_confirmed_total", 0), 1)
+        self.assertEqual(len(self.daemon.present_devices), 2)
+
+    def test_hub_removed_before_device_withdraws_prediction(self):
+        self.unplug()
+        self.send("add", HUB_PATH, HUB)
+        self.send("remove", HUB_PATH)
+        self.assertNotIn("046d:c31c", self.daemon.present_devices)
+        self.assertEqual(self.daemon._predicted, {})
+
+    def test_bind_and_change_do_not_predict(self):
+        self.unplug()
+        self.send("bind", HUB_PATH, HUB)
+        self.send("change", HUB_PATH, HUB)
+        self.assertNotIn("046d:c31c", self.daemon.present_devices)
+        self.assertEqual(metrics.registry.counters.get("predictions_total", 0), 0)
+
+
+    def test_overflow_resyncs(self):
+        # The keyboard's remove was among the uevents the socket dropped.
+        del self.udev.present[KEYBOARD_PATH]
+
+        def overflow():
+            raise OSError(errno.ENOBUFS, os.strerror(errno.ENOBUFS))
+
+        self.udev.read_pending = overflow
+        with self.assertLogs("usb_monitor", "WARNING"):
+            self.daemon._on_readable()
+        self.assertNotIn("046d:c31c", self.daemon.present_devices)
+        self.assertIsNone(self.daemon.scheduler.pending)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""DDC/CI framing and reply parsing, and I2cBackend against a pty standing in for a monitor.
+
+    python3 -m unittest discover linux/tests
+"""
+import os
+import sys
+import threading
+import tty
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import ddc  # noqa: E402
+
+
+def vcp_reply(code: int, maximum: int, current: int, result: int = 0) -> bytes:
+    """Build the reply a monitor sends to Get VCP Feature."""
+    frame = bytes([0x6E, 0x88, ddc.GET_VCP_REPLY, result, code, 0x00,
+                   maximum >> 8, maximum & 0xFF, current >> 8, current & 0xFF])
+    return frame + bytes([ddc.checksum(ddc.READ_CHECKSUM_SEED, frame)])
+
+
+def capabilities_reply(offset: int, data: bytes) -> bytes:
+    frame = bytes([0x6E, 0x80 | (len(data) + 3), ddc.CAPABILITIES_REPLY, offset >> 8, offset & 0xFF]) + data
+    return frame + bytes([ddc.checksum(ddc.READ_CHECKSUM_SEED, frame)])
+
+
+class FramingTest(unittest.TestCase):
+    def test_build_request(self):
+        # Get VCP Feature 0x10 as given in the DDC/CI spec.
+        self.assertEqual(ddc.build_request(bytes([ddc.GET_VCP_REQUEST, 0x10])), bytes([0x51, 0x82, 0x01, 0x10, 0xAC]))
+
+    def test_build_set_request(self):
+        request = ddc.build_request(bytes([ddc.SET_VCP_REQUEST, 0x60, 0x00, 0x0F]))
+        self.assertEqual(request[:6], bytes([0x51, 0x84, 0x03, 0x60, 0x00, 0x0F]))
+        self.assertEqual(ddc.checksum(ddc.WRITE_CHECKSUM_SEED, request), 0)
+
+
+class VcpReplyTest(unittest.TestCase):
+    def test_continuous(self):
+        self.assertEqual(ddc.parse_vcp_reply(vcp_reply(0x10, 100, 0x0132), 0x10), (0x0132, 100))
+
+    def test_non_continuous_uses_low_byte(self):
+        self.assertEqual(ddc.parse_vcp_reply(vcp_reply(0x60, 0x12, 0x020F), 0x60), (0x0F, 0x12))
+        self.assertEqual(ddc.parse_vcp_reply(vcp_reply(0x14, 0x0B, 0xFF05), 0x14), (0x05, 0x0B))
+
+    def test_bad_checksum(self):
+        reply = bytearray(vcp_reply(0x60, 0x12, 0x0F))
+        reply[10] ^= 0xFF
+        with self.assertRaisesRegex(ddc.DdcError, "checksum"):
+            ddc.parse_vcp_reply(bytes(reply), 0x60)
+
+    def test_short(self):
+        with self.assertRaisesRegex(ddc.DdcError, "Short"):
+            ddc.parse_vcp_reply(vcp_reply(0x60, 0x12, 0x0F)[:8], 0x60)
+
+    def test_unsupported(self):
+        with self.assertRaisesRegex(ddc.DdcError, "does not support"):
+            ddc.parse_vcp_reply(vcp_reply(0x60, 0, 0, result=1), 0x60)
+
+    def test_wrong_feature(self):
+        with self.assertRaisesRegex(ddc.DdcError, "expected 0x60"):
+            ddc.parse_vcp_reply(vcp_reply(0x10, 100, 50), 0x60)
+
+
+class CapabilitiesReplyTest(unittest.TestCase):
+    def test_fragment(self):
+        self.assertEqual(ddc.parse_capabilities_reply(capabilities_reply(32, b"(vcp(60))"), 32), b"(vcp(60))")
+
+    def test_last_fragment_is_empty(self):
+        self.assertEqual(ddc.parse_capabilities_reply(capabilities_reply(9, b""), 9), b"")
+
+    def test_wrong_offset(self):
+        with self.assertRaisesRegex(ddc.DdcError, "Unexpected"):
+            ddc.parse_capabilities_reply(capabilities_reply(0, b"(prot"), 32)
+
+    def test_truncated(self):
+        with self.assertRaisesRegex(ddc.DdcError, "Short"):
+            ddc.parse_capabilities_reply(capabilities_reply(0, b"(prot(monitor))")[:10], 0)
+
+
+class FakeMonitor:
+    """Answers requests on the master side of a pty like a monitor at 0x37 would."""
+
+    def __init__(self, capabilities: bytes, inputs: int = 0x0F):
+        self.capabilities = capabilities
+        self.values = {ddc.VCP_INPUT_SOURCE: inputs, 0x10: 40}
+        # The slave end stays open here: with no slave open, reads on the
+        # master fail with EIO before the backend gets to open it.
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self) -> None:
+        pending = b""
+        while True:
+            try:
+                pending += os.read(self.master, 64)
+            except OSError:
+                return
+            # Back to back writes can arrive in one read; split on the length byte.
+            while len(pending) >= 2 and len(pending) >= (pending[1] & 0x7F) + 3:
+                length = (pending[1] & 0x7F) + 3
+                request, pending = pending[:length], pending[length:]
+                if not ddc.checksum(ddc.WRITE_CHECKSUM_SEED, request):
+                    self._answer(request)
+
+    def _answer(self, request: bytes) -> None:
+        command = request[2]
+        if command == ddc.GET_VCP_REQUEST:
+            # Junk in SH, as some monitors send for the input source.
+            os.write(self.master, vcp_reply(request[3], 0x12, 0x0100 | self.values[request[3]]))
+        elif command == ddc.SET_VCP_REQUEST:
+            self.values[request[3]] = (request[4] << 8) | request[5]
+        elif command == ddc.CAPABILITIES_REQUEST:
+            offset = (request[3] << 8) | request[4]
+            os.write(self.master, capabilities_reply(offset, self.capabilities[offset:offset + 32]))
+
+    def close(self) -> None:
+        os.close(self._slave)
+        os.close(self.master)
+
+
+class I2cBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.monitor = FakeMonitor(b"(prot(monitor)type(lcd)model(TEST)vcp(10 60(0F 11 12))mccs_ver(2.1))")
+        self.backend = ddc.I2cBackend(7, self.monitor.path, reply_delay=0.01, command_gap=0.0)
+
+    def tearDown(self):
+        self.backend.close()
+        self.monitor.close()
+
+    def test_switch_input(self):
+        self.assertEqual(self.backend.get_vcp(ddc.VCP_INPUT_SOURCE), (0x0F, 0x12))
+        self.backend.set_vcp(ddc.VCP_INPUT_SOURCE, 0x11)
+        self.assertEqual(self.backend.get_vcps([ddc.VCP_INPUT_SOURCE, 0x10]), {ddc.VCP_INPUT_SOURCE: 0x11, 0x10: 0x0128})
+
+    def test_capabilities(self):
+        self.assertEqual(self.backend.get_capabilities(), self.monitor.capabilities.decode("ascii"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""PresenceIndex updates from uevents and enumerations."""
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "src"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "bench"))
+
+import presence  # noqa: E402
+from fakes import FakeDevice  # noqa: E402
+
+
+class DeviceKeysTest(unittest.TestCase):
+    def test_with_serial(self):
+        self.assertEqual(presence.device_keys(FakeDevice("add", "/a", "046D", "C31C", "ABC")),
+                         ("046d:c31c", "046d:*", "046d:c31c:abc", "serial:abc"))
+
+    def test_without_ids(self):
+        self.assertEqual(presence.device_keys(FakeDevice("unbind", "/a")), ())
+
+
+class PresenceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = presence.PresenceIndex()
+
+    def test_add_and_remove(self):
+        self.assertEqual(self.index.apply(FakeDevice("add", "/a", "046d", "c31c")), (("046d:c31c", "046d:*"), ()))
+        self.assertEqual(self.index.apply(FakeDevice("remove", "/a")), ((), ("046d:c31c", "046d:*")))
+        self.assertEqual(len(self.index), 0)
+
+    def test_keys_are_reference_counted(self):
+        self.index.apply(FakeDevice("add", "/a", "046d", "c31c"))
+        added, _ = self.index.apply(FakeDevice("add", "/b", "046d", "c077"))
+        self.assertEqual(added, ("046d:c077",))
+        _, removed = self.index.apply(FakeDevice("remove", "/a"))
+        self.assertEqual(removed, ("046d:c31c",))
+        self.assertIn("046d:*", self.index)
+
+    def test_rebind_reports_no_change(self):
+        self.index.apply(FakeDevice("add", "/a", "046d", "c31c"))
+        self.assertEqual(self.index.apply(FakeDevice("bind", "/a", "046d", "c31c")), ((), ()))
+
+    def test_predicted_device_confirmed_by_its_uevent(self):
+        self.assertEqual(self.index.add("/a", ("046d:c31c", "046d:*")), ("046d:c31c", "046d:*"))
+        self.assertEqual(self.index.apply(FakeDevice("add", "/a", "046d", "c31c")), ((), ()))
+
+    def test_reconcile(self):
+        self.index.apply(FakeDevice("add", "/a", "046d", "c31c"))
+        self.assertFalse(self.index.reconcile([FakeDevice("add", "/a", "046d", "c31c")], warn=False))
+        self.assertTrue(self.index.reconcile([], warn=False))
+        self.assertEqual(self.index.keys(), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Rule compilation and incremental RuleSet evaluation."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rules  # noqa: E402
+
+CONFIG = {"rules": [
+    {"name": "mac", "match": ["05ac:*", "serial:C02XYZ"], "inputs": {"left": "17"}, "priority": 10},
+    {"name": "keyboard", "match": "046d:c31c", "inputs": "connected"},
+    {"name": "dock", "match": ["17ef"], "inputs": "15"},
+]}
+
+
+class CompileRulesTest(unittest.TestCase):
+    def test_patterns_are_normalized(self):
+        mac, keyboard, dock = rules.compile_rules(CONFIG)
+        self.assertEqual(mac.patterns, ("05ac:*", "serial:c02xyz"))
+        self.assertEqual(keyboard.patterns, ("046d:c31c",))
+        self.assertEqual(dock.patterns, ("17ef:*",))
+
+    def test_legacy_keyboard_id(self):
+        (rule,) = rules.compile_rules({"keyboard_id": "046D:C31C"})
+        self.assertEqual((rule.name, rule.patterns, rule.inputs), ("keyboard", ("046d:c31c",), rules.CONNECTED))
+
+
+class RuleSetTest(unittest.TestCase):
+    def setUp(self):
+        self.ruleset = rules.RuleSet(rules.compile_rules(CONFIG))
+
+    def active(self):
+        rule = self.ruleset.active
+        return rule.name if rule else None
+
+    def test_priority_wins(self):
+        self.assertTrue(self.ruleset.apply(("046d:c31c", "046d:*"), ()))
+        self.assertEqual(self.active(), "keyboard")
+        self.assertTrue(self.ruleset.apply(("05ac:*",), ()))
+        self.assertEqual(self.active(), "mac")
+        self.assertFalse(self.ruleset.apply(("17ef:*",), ()))
+
+    def test_ties_go_to_the_first_rule(self):
+        self.ruleset.apply(("17ef:*",), ())
+        self.ruleset.apply(("046d:c31c",), ())
+        self.assertEqual(self.active(), "keyboard")
+
+    def test_winner_lost_falls_back(self):
+        self.ruleset.seed({"05ac:*", "046d:c31c"})
+        self.assertEqual(self.active(), "mac")
+        self.assertTrue(self.ruleset.apply((), ("05ac:*",)))
+        self.assertEqual(self.active(), "keyboard")
+        self.assertTrue(self.ruleset.apply((), ("046d:c31c",)))
+        self.assertIsNone(self.active())
+
+    def test_rule_matches_while_any_pattern_does(self):
+        self.ruleset.apply(("05ac:*", "serial:c02xyz"), ())
+        self.assertFalse(self.ruleset.apply((), ("05ac:*",)))
+        self.assertEqual(self.active(), "mac")
+
+    def test_watches(self):
+        self.assertTrue(self.ruleset.watches(("046d:c31c", "046d:*")))
+        self.assertFalse(self.ruleset.watches(("046d:c077", "046d:*")))
+
+
+class ResolveTargetsTest(unittest.TestCase):
+    def test_inputs(self):
+        class Display:
+            def input_for(self, connected):
+                return "15" if connected else "18"
+
+        displays = {"left": Display(), "right": Display()}
+        self.assertEqual(rules.resolve_targets("disconnected", displays), {"left": "18", "right": "18"})
+        self.assertEqual(rules.resolve_targets({"left": "17", "gone": "15"}, displays), {"left": "17"})
+        self.assertEqual(rules.resolve_targets("0x11", displays), {"left": "0x11", "right": "0x11"})
+
+
+if __name__ == "__main__":
+    unittest.main()
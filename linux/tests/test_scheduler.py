@@ -0,0 +1,63 @@
+"""SwitchScheduler debounce and hysteresis on a manual clock."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from scheduler import UNSET, SwitchScheduler  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class SwitchSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = SwitchScheduler(settle=0.3, hold=1.0, clock=self.clock)
+        self.scheduler.propose("a")
+        self.assertTrue(self.scheduler.is_due())
+        self.scheduler.commit()
+
+    def test_first_target_is_due_at_once(self):
+        self.assertEqual(self.scheduler.committed, "a")
+        self.assertIsNone(self.scheduler.timeout())
+
+    def test_hold_delays_a_quick_change(self):
+        self.scheduler.propose("b")
+        self.assertAlmostEqual(self.scheduler.timeout(), 1.0)
+        self.clock.now += 1.0
+        self.assertTrue(self.scheduler.is_due())
+        self.assertEqual(self.scheduler.commit(), "b")
+
+    def test_settle_after_hold(self):
+        self.clock.now += 5.0
+        self.scheduler.propose("b")
+        self.assertAlmostEqual(self.scheduler.timeout(), 0.3)
+
+    def test_latest_proposal_wins(self):
+        self.clock.now += 5.0
+        self.scheduler.propose("b")
+        self.clock.now += 0.2
+        self.scheduler.propose("c")
+        self.assertEqual(self.scheduler.coalesced, 1)
+        self.clock.now += 0.2
+        self.assertFalse(self.scheduler.is_due())
+        self.clock.now += 0.1
+        self.assertEqual(self.scheduler.commit(), "c")
+
+    def test_flap_is_suppressed(self):
+        self.scheduler.propose("b")
+        self.scheduler.propose("a")
+        self.assertEqual(self.scheduler.flaps_suppressed, 1)
+        self.assertIs(self.scheduler.pending, UNSET)
+        self.assertIsNone(self.scheduler.deadline)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+"""TopologyIndex bookkeeping of devices behind USB hubs."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import topology  # noqa: E402
+
+ROOT = "/sys/devices/pci0000:00/0000:00:14.0/usb1"
+KEYBOARD = ("046d:c31c", "046d:*")
+
+
+class PortChainTest(unittest.TestCase):
+    def test_hubs_outermost_first(self):
+        self.assertEqual(topology.port_chain(f"{ROOT}/1-1/1-1.4/1-1.4.2"), [f"{ROOT}/1-1", f"{ROOT}/1-1/1-1.4"])
+
+    def test_root_hub_device(self):
+        self.assertEqual(topology.port_chain(f"{ROOT}/1-1"), [])
+
+
+class TopologyIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = topology.TopologyIndex()
+        self.keyboard = f"{ROOT}/1-1/1-1.4/1-1.4.2"
+        self.index.learn(self.keyboard, KEYBOARD, watched=True)
+
+    def test_behind_every_upstream_hub(self):
+        self.assertEqual(self.index.behind(f"{ROOT}/1-1"), [(self.keyboard, KEYBOARD)])
+        self.assertEqual(self.index.behind(f"{ROOT}/1-1/1-1.4"), [(self.keyboard, KEYBOARD)])
+        self.assertEqual(self.index.behind(f"{ROOT}/1-2"), [])
+
+    def test_unwatched_device_is_forgotten(self):
+        self.index.learn(self.keyboard, ("1a40:0101", "1a40:*"), watched=False)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.behind(f"{ROOT}/1-1"), [])
+
+    def test_forget_keeps_siblings(self):
+        mouse = f"{ROOT}/1-1/1-1.3"
+        self.index.learn(mouse, ("046d:c077", "046d:*"), watched=True)
+        self.index.forget(self.keyboard)
+        self.assertEqual(self.index.behind(f"{ROOT}/1-1"), [(mouse, ("046d:c077", "046d:*"))])
+        self.assertEqual(self.index.behind(f"{ROOT}/1-1/1-1.4"), [])
+
+    def test_refresh_drops_devices_no_rule_watches(self):
+        self.index.refresh(lambda keys: "05ac:*" in keys)
+        self.assertEqual(len(self.index), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()